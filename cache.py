@@ -1,31 +1,94 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import shutil
 import pickle
+import hashlib
+import json
+import mmap
+import zlib
+import time
+import threading
+import traceback
+import collections
+import numpy
+import pandas
 import redis
 
+# ttl: 作成から指定秒数を過ぎたものは無いものとして扱う
+# max_bytes: 合計サイズの上限 (超えたら最後に使われたのが古いものから消す)
+#   ttl/max_bytes を指定するとバックグラウンドでinterval秒ごとに掃除する (専用のcache_dirを使うこと)
+#   作成日時はmtime, 最後に使った日時はatime (ttl/max_bytesがあるときだけgetで更新する) に持たせる
+#   cache_dirを省略すると /tmp (掃除するものは /tmp 直下の他のファイルを消さないように eviction_dir)
 class Cache:
-    def __init__(self, cache_dir="/tmp"):
+    suffix = ".dump"
+    eviction_dir = "/tmp/cache"
+
+    def __init__(self, cache_dir=None, ttl=None, max_bytes=None, interval=60):
+        if cache_dir is None:
+            cache_dir = "/tmp" if ttl is None and max_bytes is None else self.eviction_dir
         self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.evictor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["evictor"] = None
+        return state
 
     def dir(self):
         return self.cache_dir
 
+    def evicting(self):
+        return self.ttl is not None or self.max_bytes is not None
+
     def path(self, name):
-        return "%s/%s.dump" % (self.dir(), name)
+        return "%s/%s%s" % (self.dir(), name, self.suffix)
 
+    # 掃除で消されることがあるのでstatは1回だけ
     def exists(self, name):
-        return os.path.exists(self.path(name))
+        try:
+            stat = os.stat(self.path(name))
+        except OSError:
+            return False
+        return not self.expired(stat)
+
+    def expired(self, stat, now=None):
+        now = time.time() if now is None else now
+        return self.ttl is not None and stat.st_mtime + self.ttl < now
 
     def create(self, name, data):
-        output_dir = os.path.dirname(self.path(name))
+        self.write(name, lambda f: pickle.dump(data, f))
+
+    # 一時ファイルに書いてからrenameするので、他のプロセスが書きかけのファイルを読むことはない
+    def write(self, name, callback):
+        path = self.path(name)
+        output_dir = os.path.dirname(path)
         if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        with open(self.path(name), "wb") as f:
-            pickle.dump(data, f)
+            os.makedirs(output_dir, exist_ok=True)
+        temp = "%s.%s.%s.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp, "wb") as f:
+                callback(f)
+            os.replace(temp, path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        self.start_eviction()
+
+    def open(self, name):
+        path = self.path(name)
+        stat = os.stat(path)
+        if self.expired(stat):
+            raise FileNotFoundError(path)
+        if self.evicting():
+            os.utime(path, (time.time(), stat.st_mtime))
+        return open(path, "rb")
 
     def get(self, name):
-        with open(self.path(name), "rb") as f:
+        with self.open(name) as f:
             cache = pickle.load(f)
         return cache
 
@@ -36,18 +99,423 @@ class Cache:
         if os.path.exists(self.dir()):
             shutil.rmtree(self.dir())
 
+    def info(self, name):
+        stat = os.stat(self.path(name))
+        return {"created": stat.st_mtime, "accessed": stat.st_atime, "size": stat.st_size}
+
+    def entries(self):
+        entries = []
+        for root, _, files in os.walk(self.dir()):
+            for f in filter(lambda x: x.endswith(self.suffix), files):
+                path = os.path.join(root, f)
+                try:
+                    entries.append((path, os.stat(path)))
+                except OSError:
+                    continue
+        return entries
+
+    # 期限切れ -> 最後に使われたのが古いもの の順に消す
+    def evict(self):
+        now = time.time()
+        entries = self.entries()
+        removed = []
+
+        if self.ttl is not None:
+            removed = list(filter(lambda x: self.expired(x[1], now), entries))
+            entries = list(filter(lambda x: not self.expired(x[1], now), entries))
+
+        if self.max_bytes is not None:
+            total = sum(map(lambda x: x[1].st_size, entries))
+            for entry in sorted(entries, key=lambda x: x[1].st_atime):
+                if total <= self.max_bytes:
+                    break
+                removed.append(entry)
+                total -= entry[1].st_size
+
+        for path, _ in removed:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+        return len(removed)
+
+    # 掃除のスレッドはディレクトリと設定 (suffix, ttl, max_bytes) ごとに1つ
+    def eviction_key(self):
+        return (os.path.realpath(self.dir()), self.suffix, self.ttl, self.max_bytes)
+
+    def start_eviction(self):
+        if not self.evicting():
+            return
+        if self.evictor is not None and not self.evictor.is_stopped():
+            return
+        key = self.eviction_key()
+        with evictors_lock:
+            if key not in evictors.keys():
+                evictors[key] = CacheEvictor(self)
+                evictors[key].start()
+            self.evictor = evictors[key]
+
+    # 同じディレクトリと設定の掃除を止める (次にwriteしたら再開する)
+    def stop(self):
+        with evictors_lock:
+            evictor = evictors.pop(self.eviction_key(), None)
+        if evictor is not None:
+            evictor.stop()
+        self.evictor = None
+
+class CacheEvictor:
+    def __init__(self, cache):
+        self.cache = cache
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.cache.evict()
+            except:
+                traceback.print_exc()
+            self.stopped.wait(self.cache.interval)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def is_stopped(self):
+        return self.stopped.is_set()
+
+# (ディレクトリのrealpath, suffix, ttl, max_bytes) -> CacheEvictor
+evictors = {}
+evictors_lock = threading.Lock()
+
+# numpyの配列はpickleせずにそのままファイルに並べ、読むときはmmapしたファイルを参照する (pickle protocol 5 の out-of-band buffer)
+#   DataFrameやSimulatorDataの数値の列は読み込み時にコピーされない
+#   読み取り専用のバックエンド: 取り出した配列は圧縮の有無によらず書き換えられない (書き換える呼び出し元にはCacheを使う)
+#   compression: None / "zlib" / "lz4" / "zstd" (圧縮するとmmapではなく展開して読む)
+class ArrayCache(Cache):
+    magic = b"NPC1"
+    align = 64
+
+    suffix = ".npc"
+
+    def __init__(self, cache_dir=None, compression=None, ttl=None, max_bytes=None, interval=60):
+        super().__init__(cache_dir, ttl, max_bytes, interval)
+        self.compression = compression
+
+    @staticmethod
+    def compressor(compression):
+        if compression == "zlib":
+            return zlib.compress, zlib.decompress
+        if compression == "lz4":
+            import lz4.frame
+            return lz4.frame.compress, lz4.frame.decompress
+        if compression == "zstd":
+            import zstandard
+            return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+        raise Exception("unknown compression: %s" % compression)
+
+    def create(self, name, data):
+        buffers = []
+        body = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+        buffers = list(map(lambda x: x.raw(), buffers))
+        if self.compression is not None:
+            compress, _ = self.compressor(self.compression)
+            buffers = list(map(lambda x: compress(x), buffers))
+
+        # ヘッダの後に pickle本体, 配列 の順に並べる (配列はalignバイト境界から)
+        offset = 0
+        positions = []
+        for b in [body] + buffers:
+            offset = -(-offset // self.align) * self.align
+            positions.append([offset, memoryview(b).nbytes])
+            offset += memoryview(b).nbytes
+        header = json.dumps({"compression": self.compression, "positions": positions}).encode("utf-8")
+        start = -(-(len(self.magic) + 8 + len(header)) // self.align) * self.align
+
+        def write(f):
+            f.write(self.magic + len(header).to_bytes(8, "little") + header)
+            for (position, _), b in zip(positions, [body] + buffers):
+                f.seek(start + position)
+                f.write(b)
+        self.write(name, write)
+
+    def get(self, name):
+        with self.open(name) as f:
+            if f.read(len(self.magic)) != self.magic:
+                raise Exception("invalid cache: %s" % name)
+            length = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(length).decode("utf-8"))
+            start = -(-(len(self.magic) + 8 + length) // self.align) * self.align
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(mapped)
+        parts = list(map(lambda x: view[start + x[0]:start + x[0] + x[1]], header["positions"]))
+        body, buffers = parts[0], parts[1:]
+        # 展開した配列もmmapと同じく読み取り専用にする (bytesのまま渡す)
+        if header["compression"] is not None:
+            _, decompress = self.compressor(header["compression"])
+            buffers = list(map(lambda x: bytes(decompress(x)), buffers))
+        return pickle.loads(body, buffers=buffers)
+
+# mget/msetは1回(分割した値があれば2回)の往復でまとめて読み書きする
+#   compression: ArrayCacheと同じ (圧縮しない場合は従来どおりpickleをそのまま保存する)
+#   chunk_size: これより大きい値は "<name>:chunk:<generation>:<n>" に分けて保存する (generationは内容のハッシュ)
+#   client: redis.Redis互換のクライアント (テストではtests/fake_redis.pyのFakeRedisClientを渡す)
 class Redis:
-    def __init__(self):
-        self.client = redis.Redis(host="localhost", port=6379, db=0)
+    magic = b"RCH1"
+    header_size = 1024 # ヘッダだけを読むときに取るバイト数
+
+    def __init__(self, host="localhost", port=6379, db=0, client=None, compression=None, chunk_size=64 * 1024 * 1024):
+        self.client = redis.Redis(host=host, port=port, db=db) if client is None else client
+        self.compression = compression
+        self.chunk_size = chunk_size
 
     def exists(self, name):
         return self.client.exists(name)
 
     def create(self, name, data):
-        return self.client.set(name, pickle.dumps(data))
+        return self.mset({name: data})
 
     def get(self, name):
-        return pickle.loads(self.client.get(name))
+        found, data = self.mget([name])[0]
+        if not found:
+            raise KeyError(name)
+        return data
 
     def remove(self, name):
-        return self.client.delete(name)
+        header = self.headers([name])[0]
+        return self.client.delete(name, *self.chunk_keys(name, header))
+
+    # 分割したキーは内容のハッシュ(generation)ごとに別の名前にする
+    #   同じキーへの書き込みが重なっても、ヘッダが指すのは自分が書いた分割だけになる
+    @staticmethod
+    def chunk_keys(name, header):
+        if header is None:
+            return []
+        if "generation" not in header.keys(): # generationを持たない形式 "<name>:chunk:<n>"
+            return list(map(lambda i: "%s:chunk:%s" % (name, i), range(header["chunks"])))
+        return list(map(lambda i: "%s:chunk:%s:%s" % (name, header["generation"], i), range(header["chunks"])))
+
+    def header(self, value):
+        if value is None or not value.startswith(self.magic):
+            return None
+        length = int.from_bytes(value[len(self.magic):len(self.magic)+4], "little")
+        return json.loads(value[len(self.magic)+4:len(self.magic)+4+length].decode("utf-8"))
+
+    # 値の先頭だけを読んでヘッダを返す
+    def headers(self, names):
+        pipeline = self.client.pipeline(transaction=False)
+        for name in names:
+            pipeline.getrange(name, 0, self.header_size - 1)
+        return list(map(lambda x: self.header(x), pipeline.execute()))
+
+    # 分割したキー, nameの順に返す (分割を書いてからヘッダを書く)
+    def encode(self, name, data):
+        value = pickle.dumps(data)
+        if self.compression is None and len(value) <= self.chunk_size:
+            return {name: value}
+
+        if self.compression is not None:
+            compress, _ = ArrayCache.compressor(self.compression)
+            value = compress(value)
+
+        chunks = [] if len(value) <= self.chunk_size else [value[i:i+self.chunk_size] for i in range(0, len(value), self.chunk_size)]
+        header = {"compression": self.compression, "chunks": len(chunks), "generation": hashlib.sha1(value).hexdigest()[:16]}
+        encoded = dict(zip(self.chunk_keys(name, header), chunks))
+        header = json.dumps(header).encode("utf-8")
+        encoded[name] = self.magic + len(header).to_bytes(4, "little") + header + (b"" if len(chunks) > 0 else value)
+        return encoded
+
+    def decode(self, value, chunks):
+        header = self.header(value)
+        if header is None:
+            return pickle.loads(value)
+        if header["chunks"] > 0:
+            value = b"".join(chunks)
+        else:
+            value = value[len(self.magic)+4+int.from_bytes(value[len(self.magic):len(self.magic)+4], "little"):]
+        if header["compression"] is not None:
+            _, decompress = ArrayCache.compressor(header["compression"])
+            value = decompress(value)
+        return pickle.loads(value)
+
+    # {name: data} をパイプラインで書き込む (前の値のヘッダを読む1回 + 書き込みの1回)
+    #   前の値の分割したキーは同じパイプラインで消す
+    def mset(self, items):
+        if len(items) == 0:
+            return True
+        previous = self.headers(items.keys())
+
+        pipeline = self.client.pipeline(transaction=False)
+        size = 0
+        stale = []
+        for (name, data), header in zip(items.items(), previous):
+            encoded = self.encode(name, data)
+            for key, value in encoded.items():
+                pipeline.set(key, value)
+            size += len(encoded)
+            stale += list(filter(lambda x: x not in encoded.keys(), self.chunk_keys(name, header)))
+        if len(stale) > 0:
+            pipeline.delete(*stale)
+        return all(pipeline.execute()[:size])
+
+    # [(見つかったか, data)] を返す
+    def mget(self, names):
+        names = list(names)
+        if len(names) == 0:
+            return []
+        values = self.client.mget(names)
+        headers = list(map(lambda x: self.header(x), values))
+
+        # 分割されたものだけもう1回でまとめて取る
+        chunk_keys = list(map(lambda x: self.chunk_keys(x[0], x[1]), zip(names, headers)))
+        keys = sum(chunk_keys, [])
+        chunks = dict(zip(keys, self.client.mget(keys))) if len(keys) > 0 else {}
+
+        results = []
+        for value, keys in zip(values, chunk_keys):
+            if value is None or any(map(lambda x: chunks[x] is None, keys)):
+                results.append((False, None))
+                continue
+            results.append((True, self.decode(value, list(map(lambda x: chunks[x], keys)))))
+        return results
+
+# メモリ上のサイズ (バイト)
+def sizeof(data, seen=None):
+    seen = set() if seen is None else seen
+    if id(data) in seen:
+        return 0
+    seen.add(id(data))
+
+    if isinstance(data, (pandas.DataFrame, pandas.Series, pandas.Index)):
+        size = data.memory_usage(deep=True)
+        return int(size.sum()) if isinstance(size, pandas.Series) else int(size)
+    if isinstance(data, numpy.ndarray):
+        return data.nbytes
+    if isinstance(data, dict):
+        return sys.getsizeof(data) + sum(map(lambda x: sizeof(x[0], seen) + sizeof(x[1], seen), data.items()))
+    if isinstance(data, (list, tuple, set)):
+        return sys.getsizeof(data) + sum(map(lambda x: sizeof(x, seen), data))
+    if hasattr(data, "__dict__"):
+        return sys.getsizeof(data) + sizeof(vars(data), seen)
+    return sys.getsizeof(data)
+
+# プロセス内のLRU (max_bytesを超えたら古いものから捨てる)
+class MemoryCache:
+    def __init__(self, max_bytes=1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.items = collections.OrderedDict() # name -> (data, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def exists(self, name):
+        return name in self.items.keys()
+
+    def create(self, name, data):
+        self.remove(name)
+        size = sizeof(data)
+        if size > self.max_bytes:
+            return
+        self.items[name] = (data, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self.items.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def get(self, name):
+        if name not in self.items.keys():
+            self.misses += 1
+            raise KeyError(name)
+        self.hits += 1
+        self.items.move_to_end(name)
+        return self.items[name][0]
+
+    def remove(self, name):
+        if name in self.items.keys():
+            _, size = self.items.pop(name)
+            self.bytes -= size
+
+    def clear(self):
+        self.items.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "items": len(self.items), "bytes": self.bytes}
+
+# MemoryCacheを前に置いたCache/Redis
+#   取り出したものはプロセス内で共有されるので書き換えないこと
+class TieredCache:
+    def __init__(self, backend, memory=None):
+        self.backend = backend
+        self.memory = MemoryCache() if memory is None else memory
+
+    def exists(self, name):
+        return self.memory.exists(name) or self.backend.exists(name)
+
+    def create(self, name, data):
+        self.memory.create(name, data)
+        return self.backend.create(name, data)
+
+    def get(self, name):
+        try:
+            return self.memory.get(name)
+        except KeyError:
+            data = self.backend.get(name)
+            self.memory.create(name, data)
+            return data
+
+    def remove(self, name):
+        self.memory.remove(name)
+        return self.backend.remove(name)
+
+    def stats(self):
+        return self.memory.stats()
+
+# 内容で決まるキー ========
+#   引数と元ファイルの (パス, 更新日時, サイズ) が同じなら同じキーになり、元ファイルが更新されれば別のキーになる
+def content_key(*parts):
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (path, None, None)
+    if os.path.isdir(path):
+        return (path, sorted(map(lambda x: file_signature(x.path), os.scandir(path))))
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+#   backendの既定はディスクの前にプロセス内のLRUを置いたTieredCache (同じプロセスで同じものを読み直すときはメモリから返す)
+#   MemoryCacheを挟むと取り出したものが共有され、ArrayCacheは読み取り専用の配列を返すため、書き換える呼び出し元(add_statsなど)があるならCache/Redisを使う
+class ContentCache:
+    def __init__(self, backend=None):
+        self.backend = TieredCache(Cache("/tmp/content_cache")) if backend is None else backend
+
+    def load(self, parts, callback):
+        key = content_key(*parts)
+        if self.backend.exists(key):
+            try:
+                return self.backend.get(key)
+            except:
+                pass # 読めなければ作り直す
+        data = callback()
+        if data is not None:
+            self.backend.create(key, data)
+        return data
+
+# ContentCacheを設定すると cached を通した読み込みが保存される
+content_cache = None
+
+# sources: 元ファイルのパスのリストを返す関数 (キャッシュを使うときだけ呼ぶ)
+def cached(name, args, sources, callback):
+    if content_cache is None:
+        return callback()
+    return content_cache.load((name, args, list(map(file_signature, sources()))), callback)
+
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from strategy import select
+from strategy import Condition
 
 def average_conditions(legs=["daily"]):
     columns = ["daily_average", "weekly_average"]
@@ -11,13 +11,13 @@ def average_conditions(legs=["daily"]):
         for column in columns:
             for target in targets:
                 conditions = conditions + [
-                    lambda d, leg=leg, column=column, target=target: select(d, leg)[column].iloc[-1] > select(d, leg)[target].iloc[-1],
-                    lambda d, leg=leg, column=column, target=target: select(d, leg)[column].iloc[-1] < select(d, leg)[target].iloc[-1],
+                    Condition(leg, column, ">", target),
+                    Condition(leg, column, "<", target),
                 ]
 
         conditions = conditions + [
-            lambda d, leg=leg: select(d, leg)["volume"].iloc[-1] > select(d, leg)["volume_average"].iloc[-1],
-            lambda d, leg=leg: select(d, leg)["volume"].iloc[-1] < select(d, leg)["volume_average"].iloc[-1],
+            Condition(leg, "volume", ">", "volume_average"),
+            Condition(leg, "volume", "<", "volume_average"),
         ]
 
     return conditions
@@ -27,29 +27,29 @@ def tec_conditions(legs=["daily"]):
     conditions = []
     for leg in legs:
         rci = [
-            lambda d, leg=leg: select(d, leg)["rci"].iloc[-1] > 80,
-            lambda d, leg=leg: select(d, leg)["rci"].iloc[-1] < 80,
-            lambda d, leg=leg: select(d, leg)["rci"].iloc[-1] < -80,
-            lambda d, leg=leg: select(d, leg)["rci"].iloc[-1] > -80,
-            lambda d, leg=leg: select(d, leg)["rci_long"].iloc[-1] > 80,
-            lambda d, leg=leg: select(d, leg)["rci_long"].iloc[-1] < 80,
-            lambda d, leg=leg: select(d, leg)["rci_long"].iloc[-1] < -80,
-            lambda d, leg=leg: select(d, leg)["rci_long"].iloc[-1] > -80,
-            lambda d, leg=leg: select(d, leg)["rci"].iloc[-1] > select(d, leg)["rci_long"].iloc[-1],
-            lambda d, leg=leg: select(d, leg)["rci"].iloc[-1] < select(d, leg)["rci_long"].iloc[-1]
+            Condition(leg, "rci", ">", 80),
+            Condition(leg, "rci", "<", 80),
+            Condition(leg, "rci", "<", -80),
+            Condition(leg, "rci", ">", -80),
+            Condition(leg, "rci_long", ">", 80),
+            Condition(leg, "rci_long", "<", 80),
+            Condition(leg, "rci_long", "<", -80),
+            Condition(leg, "rci_long", ">", -80),
+            Condition(leg, "rci", ">", "rci_long"),
+            Condition(leg, "rci", "<", "rci_long")
         ]
         macd = [
-            lambda d, leg=leg: select(d, leg)["macd"].iloc[-1] > 0,
-            lambda d, leg=leg: select(d, leg)["macd"].iloc[-1] < 0,
-            lambda d, leg=leg: select(d, leg)["macdsignal"].iloc[-1] > 0,
-            lambda d, leg=leg: select(d, leg)["macdsignal"].iloc[-1] < 0,
-            lambda d, leg=leg: select(d, leg)["macd"].iloc[-1] > select(d, leg)["macdsignal"].iloc[-1],
-            lambda d, leg=leg: select(d, leg)["macd"].iloc[-1] < select(d, leg)["macdsignal"].iloc[-1],
-            lambda d, leg=leg: select(d, leg)["macdhist"].iloc[-1] > 0,
-            lambda d, leg=leg: select(d, leg)["macdhist"].iloc[-1] < 0,
-            lambda d, leg=leg: select(d, leg)["macdhist_convert"].iloc[-1] == 1,
-            lambda d, leg=leg: select(d, leg)["macdhist_convert"].iloc[-1] == 0,
-            lambda d, leg=leg: select(d, leg)["macdhist_convert"].iloc[-1] == -1,
+            Condition(leg, "macd", ">", 0),
+            Condition(leg, "macd", "<", 0),
+            Condition(leg, "macdsignal", ">", 0),
+            Condition(leg, "macdsignal", "<", 0),
+            Condition(leg, "macd", ">", "macdsignal"),
+            Condition(leg, "macd", "<", "macdsignal"),
+            Condition(leg, "macdhist", ">", 0),
+            Condition(leg, "macdhist", "<", 0),
+            Condition(leg, "macdhist_convert", "==", 1),
+            Condition(leg, "macdhist_convert", "==", 0),
+            Condition(leg, "macdhist_convert", "==", -1),
         ]
         conditions = (conditions + rci) if "rci" in columns else conditions
         conditions = (conditions + macd) if "macd" in columns else conditions
@@ -59,8 +59,8 @@ def band_conditions(legs=["daily"]):
     conditions = []
     for leg in legs:
         conditions = conditions + [
-            lambda d, leg=leg: select(d, leg)["env_entity"].iloc[-1] < select(d, leg)["env_entity_average"].iloc[-1],
-            lambda d, leg=leg: select(d, leg)["env_entity"].iloc[-1] > select(d, leg)["env_entity_average"].iloc[-1],
+            Condition(leg, "env_entity", "<", "env_entity_average"),
+            Condition(leg, "env_entity", ">", "env_entity_average"),
         ]
     return conditions
 
@@ -72,25 +72,25 @@ def stages_conditions(legs=["daily"]):
     conditions = []
     for leg in legs:
         conditions = conditions + [
-            lambda d, leg=leg: select(d, leg)["stages"].iloc[-1] == -2,
-            lambda d, leg=leg: select(d, leg)["stages"].iloc[-1] == -1,
-            lambda d, leg=leg: select(d, leg)["stages"].iloc[-1] == 0,
-            lambda d, leg=leg: select(d, leg)["stages"].iloc[-1] == 1,
-            lambda d, leg=leg: select(d, leg)["stages"].iloc[-1] == 2,
-            lambda d, leg=leg: select(d, leg)["stages"].iloc[-1] < select(d, leg)["stages_average"].iloc[-1],
-            lambda d, leg=leg: select(d, leg)["stages"].iloc[-1] > select(d, leg)["stages_average"].iloc[-1],
-            lambda d, leg=leg: select(d, leg)["stages"].iloc[-1] > 0,
-            lambda d, leg=leg: select(d, leg)["stages"].iloc[-1] < 0,
-            lambda d, leg=leg: select(d, leg)["stages_average"].iloc[-1] > 0,
-            lambda d, leg=leg: select(d, leg)["stages_average"].iloc[-1] < 0,
-            lambda d, leg=leg: select(d, leg)["stages"][-3:].min() > 0,
-            lambda d, leg=leg: select(d, leg)["stages"][-3:].min() < 0,
-            lambda d, leg=leg: select(d, leg)["stages"][-3:].max() > 0,
-            lambda d, leg=leg: select(d, leg)["stages"][-3:].max() < 0,
-            lambda d, leg=leg: select(d, leg)["stages_average"][-3:].min() > 0,
-            lambda d, leg=leg: select(d, leg)["stages_average"][-3:].min() < 0,
-            lambda d, leg=leg: select(d, leg)["stages_average"][-3:].max() > 0,
-            lambda d, leg=leg: select(d, leg)["stages_average"][-3:].max() < 0,
+            Condition(leg, "stages", "==", -2),
+            Condition(leg, "stages", "==", -1),
+            Condition(leg, "stages", "==", 0),
+            Condition(leg, "stages", "==", 1),
+            Condition(leg, "stages", "==", 2),
+            Condition(leg, "stages", "<", "stages_average"),
+            Condition(leg, "stages", ">", "stages_average"),
+            Condition(leg, "stages", ">", 0),
+            Condition(leg, "stages", "<", 0),
+            Condition(leg, "stages_average", ">", 0),
+            Condition(leg, "stages_average", "<", 0),
+            Condition(leg, "stages", ">", 0, reducer="min", n=3),
+            Condition(leg, "stages", "<", 0, reducer="min", n=3),
+            Condition(leg, "stages", ">", 0, reducer="max", n=3),
+            Condition(leg, "stages", "<", 0, reducer="max", n=3),
+            Condition(leg, "stages_average", ">", 0, reducer="min", n=3),
+            Condition(leg, "stages_average", "<", 0, reducer="min", n=3),
+            Condition(leg, "stages_average", ">", 0, reducer="max", n=3),
+            Condition(leg, "stages_average", "<", 0, reducer="max", n=3),
         ]
     return conditions
 
@@ -103,15 +103,15 @@ def cross_conditions(legs=["daily"]):
     for leg in legs:
         for column in columns:
             conditions = conditions + [
-                lambda d, leg=leg, column=column: select(d, leg)[column].iloc[-1] == 1,
-                lambda d, leg=leg, column=column: select(d, leg)[column].iloc[-1] == 0,
-                lambda d, leg=leg, column=column: select(d, leg)[column].iloc[-1] == -1,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].max() == 1,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].max() == 0,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].max() == -1,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].min() == 1,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].min() == 0,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].min() == -1,
+                Condition(leg, column, "==", 1),
+                Condition(leg, column, "==", 0),
+                Condition(leg, column, "==", -1),
+                Condition(leg, column, "==", 1, reducer="max", n=3),
+                Condition(leg, column, "==", 0, reducer="max", n=3),
+                Condition(leg, column, "==", -1, reducer="max", n=3),
+                Condition(leg, column, "==", 1, reducer="min", n=3),
+                Condition(leg, column, "==", 0, reducer="min", n=3),
+                Condition(leg, column, "==", -1, reducer="min", n=3),
             ]
 
     return conditions
@@ -126,15 +126,15 @@ def trend_conditions(legs=["daily"]):
     for leg in legs:
         for column in columns:
             conditions = conditions + [
-                lambda d, leg=leg, column=column: select(d, leg)[column].iloc[-1] == 1,
-                lambda d, leg=leg, column=column: select(d, leg)[column].iloc[-1] == 0,
-                lambda d, leg=leg, column=column: select(d, leg)[column].iloc[-1] == -1,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].max() == 1,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].max() == 0,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].max() == -1,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].min() == 1,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].min() == 0,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].min() == -1,
+                Condition(leg, column, "==", 1),
+                Condition(leg, column, "==", 0),
+                Condition(leg, column, "==", -1),
+                Condition(leg, column, "==", 1, reducer="max", n=3),
+                Condition(leg, column, "==", 0, reducer="max", n=3),
+                Condition(leg, column, "==", -1, reducer="max", n=3),
+                Condition(leg, column, "==", 1, reducer="min", n=3),
+                Condition(leg, column, "==", 0, reducer="min", n=3),
+                Condition(leg, column, "==", -1, reducer="min", n=3),
             ]
 
     return conditions
@@ -151,59 +151,59 @@ def cs_conditions(legs=["daily"]):
     for leg in legs:
         for column in columns:
             conditions = conditions + [
-                lambda d, leg=leg, column=column: select(d, leg)[column].iloc[-1] == 1,
-                lambda d, leg=leg, column=column: select(d, leg)[column].iloc[-1] == 0,
-                lambda d, leg=leg, column=column: select(d, leg)[column][-3:].max() == 1,
+                Condition(leg, column, "==", 1),
+                Condition(leg, column, "==", 0),
+                Condition(leg, column, "==", 1, reducer="max", n=3),
             ]
 
         conditions = conditions + [
-            lambda d, leg=leg: select(d, leg)["entity"].iloc[-1] < select(d, leg)["entity_average"].iloc[-1],
-            lambda d, leg=leg: select(d, leg)["entity"].iloc[-1] > select(d, leg)["entity_average"].iloc[-1],
+            Condition(leg, "entity", "<", "entity_average"),
+            Condition(leg, "entity", ">", "entity_average"),
         ]
 
     return conditions
 
 def new_score_conditions():
     conditions = [
-        lambda d: select(d, "new_score")["score"].iloc[-1] < select(d, "new_score")["score"].iloc[-2],
-        lambda d: select(d, "new_score")["score"].iloc[-1] > select(d, "new_score")["score"].iloc[-2],
-        lambda d: select(d, "new_score")["score"].iloc[-1] < -500,
-        lambda d: select(d, "new_score")["score"].iloc[-1] < -1000,
-        lambda d: select(d, "new_score")["score"].iloc[-1] < -2000,
-        lambda d: select(d, "new_score")["score"].iloc[-5:].min() < -500,
-        lambda d: select(d, "new_score")["score"].iloc[-10:].min() < -500,
-        lambda d: select(d, "new_score")["score"].iloc[-20:].min() < -500,
-        lambda d: select(d, "new_score")["score"].iloc[-5:].min() < -1000,
-        lambda d: select(d, "new_score")["score"].iloc[-10:].min() < -1000,
-        lambda d: select(d, "new_score")["score"].iloc[-20:].min() < -1000,
-        lambda d: select(d, "new_score")["score"].iloc[-5:].min() < -2000,
-        lambda d: select(d, "new_score")["score"].iloc[-10:].min() < -2000,
-        lambda d: select(d, "new_score")["score"].iloc[-20:].min() < -2000,
-        lambda d: select(d, "new_score")["score"].iloc[-1] > 50,
-        lambda d: select(d, "new_score")["score"].iloc[-1] > 100,
-        lambda d: select(d, "new_score")["score"].iloc[-1] > 200,
-        lambda d: select(d, "new_score")["score"].iloc[-5:].min() > 50,
-        lambda d: select(d, "new_score")["score"].iloc[-10:].min() > 50,
-        lambda d: select(d, "new_score")["score"].iloc[-20:].min() > 50,
-        lambda d: select(d, "new_score")["score"].iloc[-5:].min() > 100,
-        lambda d: select(d, "new_score")["score"].iloc[-10:].min() > 100,
-        lambda d: select(d, "new_score")["score"].iloc[-20:].min() > 100,
-        lambda d: select(d, "new_score")["score"].iloc[-5:].min() > 200,
-        lambda d: select(d, "new_score")["score"].iloc[-10:].min() > 200,
-        lambda d: select(d, "new_score")["score"].iloc[-20:].min() > 200,
+        Condition("new_score", "score", "<", "score", operand_n=2),
+        Condition("new_score", "score", ">", "score", operand_n=2),
+        Condition("new_score", "score", "<", -500),
+        Condition("new_score", "score", "<", -1000),
+        Condition("new_score", "score", "<", -2000),
+        Condition("new_score", "score", "<", -500, reducer="min", n=5),
+        Condition("new_score", "score", "<", -500, reducer="min", n=10),
+        Condition("new_score", "score", "<", -500, reducer="min", n=20),
+        Condition("new_score", "score", "<", -1000, reducer="min", n=5),
+        Condition("new_score", "score", "<", -1000, reducer="min", n=10),
+        Condition("new_score", "score", "<", -1000, reducer="min", n=20),
+        Condition("new_score", "score", "<", -2000, reducer="min", n=5),
+        Condition("new_score", "score", "<", -2000, reducer="min", n=10),
+        Condition("new_score", "score", "<", -2000, reducer="min", n=20),
+        Condition("new_score", "score", ">", 50),
+        Condition("new_score", "score", ">", 100),
+        Condition("new_score", "score", ">", 200),
+        Condition("new_score", "score", ">", 50, reducer="min", n=5),
+        Condition("new_score", "score", ">", 50, reducer="min", n=10),
+        Condition("new_score", "score", ">", 50, reducer="min", n=20),
+        Condition("new_score", "score", ">", 100, reducer="min", n=5),
+        Condition("new_score", "score", ">", 100, reducer="min", n=10),
+        Condition("new_score", "score", ">", 100, reducer="min", n=20),
+        Condition("new_score", "score", ">", 200, reducer="min", n=5),
+        Condition("new_score", "score", ">", 200, reducer="min", n=10),
+        Condition("new_score", "score", ">", 200, reducer="min", n=20),
     ]
     return conditions
 
 def industry_score_conditions():
     conditions = [
-        lambda d: select(d, "industry_score")["featured_falling"].iloc[-5:].max() < 10,
-        lambda d: select(d, "industry_score")["featured_falling"].iloc[-5:].max() > 10,
-        lambda d: select(d, "industry_score")["featured_rising"].iloc[-5:].max() < 10,
-        lambda d: select(d, "industry_score")["featured_rising"].iloc[-5:].max() > 10,
-        lambda d: select(d, "industry_score")["rising"].iloc[-5:].max() < 20,
-        lambda d: select(d, "industry_score")["rising"].iloc[-5:].max() > 20,
-        lambda d: select(d, "industry_score")["falling"].iloc[-5:].max() < 20,
-        lambda d: select(d, "industry_score")["falling"].iloc[-5:].max() > 20,
+        Condition("industry_score", "featured_falling", "<", 10, reducer="max", n=5),
+        Condition("industry_score", "featured_falling", ">", 10, reducer="max", n=5),
+        Condition("industry_score", "featured_rising", "<", 10, reducer="max", n=5),
+        Condition("industry_score", "featured_rising", ">", 10, reducer="max", n=5),
+        Condition("industry_score", "rising", "<", 20, reducer="max", n=5),
+        Condition("industry_score", "rising", ">", 20, reducer="max", n=5),
+        Condition("industry_score", "falling", "<", 20, reducer="max", n=5),
+        Condition("industry_score", "falling", ">", 20, reducer="max", n=5),
     ]
     return conditions
 
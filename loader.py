@@ -3,9 +3,12 @@ import os
 import numpy
 import pandas
 import json
+import threading
 import utils
+import cache
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from multiprocessing.pool import ThreadPool
 
 class Index:
     nikkei = "nikkei"
@@ -43,6 +46,38 @@ class Bitcoin:
 class Futures:
     codes = ["nikkei225mini"]
 
+# 取引時間 (分単位の表で判定する)
+#   ranges: [("HH:MM", "HH:MM")] 両端を含む。終わりが始まりより前なら日をまたぐ
+class Session:
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.mask = numpy.zeros(24 * 60, dtype=bool)
+        for start, end in ranges:
+            start, end = self.minute(start), self.minute(end)
+            if start <= end:
+                self.mask[start:end+1] = True
+            else:
+                self.mask[start:] = True
+                self.mask[:end+1] = True
+
+    @staticmethod
+    def minute(time):
+        hour, minute = time.split(":")
+        return int(hour) * 60 + int(minute)
+
+    # 日時 -> 0時からの分
+    @staticmethod
+    def minutes(dates):
+        return numpy.asarray(dates, dtype="datetime64[ns]").astype("datetime64[m]").astype("int64") % (24 * 60)
+
+    def contains(self, dates):
+        return self.mask[self.minutes(dates)]
+
+    def filter(self, data):
+        data = data[self.contains(data["date"])]
+        data = data.reset_index()
+        return data
+
 class Loader:
     workspace_dir = os.path.expanduser("~/workspace")
 
@@ -56,9 +91,22 @@ class Loader:
     realtime_dir = "%s/realtime" % base_dir
     realtime_minutes_dir = "%s/realtime/minutes" % base_dir
     futures_dir = "%s/futures" % base_dir
+    columnar_dir = "%s/columnar" % base_dir
+    file_index_dir = "%s/file_index" % base_dir
+    tick_bars_dir = "%s/tick_bars" % base_dir
 
     foreign_dir = "%s/foreign_stocks" % workspace_dir
 
+    read_threads = 8
+
+    sessions = {
+        "stock": Session([("08:59", "11:30"), ("12:30", "14:59")]),
+        "nikkei225mini_day": Session([("08:45", "15:45")]),
+        "nikkei225mini_night": Session([("17:00", "06:00")]),
+        "nikkei225mini": Session([("08:45", "15:45"), ("17:00", "06:00")]),
+        "bitcoin": Session([("00:00", "23:59")]),
+    }
+
     stock_agg = {"open":"first", "high":"max", "low":"min", "close":"last", "volume":"last"}
     index_agg = {"open":"first", "high":"max", "low":"min", "close":"last"}
 
@@ -85,20 +133,19 @@ class Loader:
         start = utils.to_datetime(start_date)
         end = utils.to_datetime(end_date)
         current = start
-        data = None
+        paths = []
         while current <= end:
             current = utils.to_datetime(utils.to_format(current + relativedelta(days=1), output_format="%Y-%m-%d"))
-            try:
-                data_ = pandas.read_csv(Loader.bitcoin_dir + "/" + str(code) + "/" + utils.to_format(current) + ".csv")
-            except:
-                continue
-            data = data_ if (data is None) else pandas.concat([data, data_])
+            paths.append(Loader.bitcoin_dir + "/" + str(code) + "/" + utils.to_format(current) + ".csv")
+
+        # 1日1ファイルなのでスレッドで並列に読んで最後に1回だけ結合する
+        with ThreadPool(Loader.read_threads) as pool:
+            frames = pool.map(Loader.read_csv, paths)
+        data = Loader.concat(frames)
 
         if data is None:
           return None
-        data = Loader.format(data, float, date_format="%Y-%m-%d %H:%M:%S")
-        data["low"] = data[["low", "open", "close"]].apply(min, axis=1)
-        data["high"] = data[["high", "open", "close"]].apply(max, axis=1)
+        data = Loader.format(data, float, date_format="%Y-%m-%d %H:%M:%S", sanitize=True)
         if with_filter:
           end_time = "23:59:59" if time is None else utils.format("%s %s" % (end_date, time), output_format="%H:%M:%S")
           filtered = Loader.filter(data, "%s 00:00:00" % start_date, "%s %s" % (end_date, end_time), strict)
@@ -109,8 +156,24 @@ class Loader:
 
         return data
 
+    # 読めないファイルはNone
     @staticmethod
-    def format(data, data_type, columns=['date', 'open', 'high', 'low', 'close', "volume"], replace="-", how="any", date_format='%Y-%m-%d'):
+    def read_csv(path, **kwargs):
+        try:
+            return pandas.read_csv(path, **kwargs)
+        except:
+            return None
+
+    # 読み込んだものを1回だけ結合する (全てNoneならNone)
+    @staticmethod
+    def concat(frames):
+        frames = list(filter(lambda x: x is not None, frames))
+        if len(frames) == 0:
+            return None
+        return frames[0] if len(frames) == 1 else pandas.concat(frames)
+
+    @staticmethod
+    def format(data, data_type, columns=['date', 'open', 'high', 'low', 'close', "volume"], replace="-", how="any", date_format='%Y-%m-%d', sanitize=False):
         data.columns = columns
         data = data.replace(replace, numpy.nan)
         data = data.dropna(how=how)
@@ -120,10 +183,44 @@ class Loader:
                 continue
             data[column] = data[column].astype(data_type)
         data = data.reset_index(drop=True)
+        if sanitize:
+            data = Loader.sanitize(data)
         return data
 
+    # OHLCの整合性 (low <= open, close <= high) をそろえる
+    #   repair: low/highをopen/closeまで広げる
+    #   drop: 価格が数値でない・0以下・low/highの外にある足を除く (Falseならcorrupt列に印をつける)
+    @staticmethod
+    def sanitize(data, repair=True, drop=True):
+        o, h, l, c = map(lambda x: data[x].to_numpy(), ["open", "high", "low", "close"])
+
+        if repair:
+            l = numpy.minimum(numpy.minimum(l, o), c)
+            h = numpy.maximum(numpy.maximum(h, o), c)
+            data["low"] = l
+            data["high"] = h
+
+        prices = numpy.array([o, h, l, c], dtype="f8")
+        corrupt = ~numpy.isfinite(prices).all(axis=0) | (prices <= 0).any(axis=0)
+        corrupt |= (l > numpy.minimum(o, c)) | (numpy.maximum(o, c) > h)
+
+        if not drop:
+            data["corrupt"] = corrupt * 1
+            return data
+
+        if corrupt.any():
+            data = data[~corrupt].reset_index(drop=True)
+        return data
+
+    # cache.content_cacheを設定したときだけキャッシュする (既定ではキャッシュしない)
+    #   元ファイルに加えて読み込みのコード(このファイル)が変わったら読み直す
     @staticmethod
     def load_index(name, start_date=None, end_date=None, with_filter=True, strict=False, data_type=int):
+        sources = lambda: Loader.sources(name) + [__file__]
+        return cache.cached("Loader.load_index", (name, start_date, end_date, with_filter, strict, data_type), sources, lambda: Loader.load_index_uncached(name, start_date, end_date, with_filter, strict, data_type))
+
+    @staticmethod
+    def load_index_uncached(name, start_date=None, end_date=None, with_filter=True, strict=False, data_type=int):
         try:
             data = pandas.read_csv(Loader.base_dir + "/index/" + name + ".csv", header=None)
         except:
@@ -154,15 +251,12 @@ class Loader:
         start = utils.to_datetime(start_date)
         end = utils.to_datetime(end_date)
         current = start
-        data = None
+        frames = []
         while current <= end:
             month = current.strftime("%Y%m")
             current = utils.to_datetime(utils.to_format(current + relativedelta(months=1), output_format="%Y-%m-01"))
-            try:
-                data_ = pandas.read_csv(Loader.tick_dir + "/" + month + "/" + str(code) + ".csv", header=None)
-            except:
-                continue
-            data = data_ if (data is None) else pandas.concat([data, data_])
+            frames.append(Loader.read_csv(Loader.tick_dir + "/" + month + "/" + str(code) + ".csv", header=None))
+        data = Loader.concat(frames)
 
         if data is None:
           return None
@@ -177,36 +271,108 @@ class Loader:
 
     @staticmethod
     def load_stock_tick_ohlc(code, start_date, end_date, rule="5T", time=None):
-        daily = Loader.load(code, start_date, end_date)
-        columns = ["code", "date", "time", "price", "volume"]
-        columns_dict = {}
-        for column in columns:
-            columns_dict[column] = []
-
-        for i, row in daily.iterrows():
-            for column, d in zip(columns, ["%s0" % code, utils.format(str(row["date"]), input_format="%Y-%m-%d %H:%M:%S", output_format="%Y%m%d"), 90000000000, row["open"], 0]):
-                columns_dict[column].append(d)
-            for column, d in zip(columns, ["%s0" % code, utils.format(str(row["date"]), input_format="%Y-%m-%d %H:%M:%S", output_format="%Y%m%d"), 150000000000, row["close"], None]):
-                columns_dict[column].append(d)
-
-        oc = pandas.DataFrame(columns_dict, columns=columns)
-        oc = Loader.tick_format(oc)
+        # 途中までの時刻指定がなければ月ごとに作った足を使う
+        if time is None and Loader.tick_bars_cacheable(rule):
+            ohlc = Loader.load_tick_bars(code, start_date, end_date, rule)
+        else:
+            ohlc = Loader.tick_bars(Loader.load_stock_tick(code, start_date, end_date, time), rule)
+        ohlc = ohlc.ffill()
+        ohlc = ohlc.reset_index()
+        ohlc = Loader.zaraba_filter(ohlc)
+        return ohlc
 
+    # ティック + 日足の寄り付き・大引けの仮のティック
+    @staticmethod
+    def load_stock_tick(code, start_date, end_date, time=None):
+        daily = Loader.load(code, start_date, end_date)
+        oc = None if daily is None else Loader.session_ticks(code, daily)
         tick = Loader.load_tick(code, start_date, end_date, time=time)
-        if tick is None:
-            tick = oc
-        else:
-            tick = pandas.concat([tick, oc])
+        return Loader.concat([tick, oc])
+
+    @staticmethod
+    def session_ticks(code, daily):
+        length = len(daily)
+        columns_dict = {
+            "code": ["%s0" % code] * (length * 2),
+            "date": numpy.repeat(daily["date"].dt.strftime("%Y%m%d").to_numpy(), 2),
+            "time": numpy.tile([90000000000, 150000000000], length),
+            "price": numpy.column_stack([daily["open"].to_numpy(), daily["close"].to_numpy()]).ravel(),
+            "volume": numpy.tile([0, numpy.nan], length),
+        }
+        oc = pandas.DataFrame(columns_dict, columns=["code", "date", "time", "price", "volume"])
+        return Loader.tick_format(oc)
 
+    @staticmethod
+    def tick_bars(tick, rule):
         tick = tick.set_index("date")
         ohlc = pandas.Series(tick["price"]).resample(rule).ohlc()
         volume = pandas.Series(tick["volume"]).resample(rule).sum()
         ohlc["volume"] = volume
-        ohlc = ohlc.ffill()
-        ohlc = ohlc.reset_index()
-        ohlc = Loader.zaraba_filter(ohlc)
         return ohlc
 
+    # 足が日をまたがなければ月ごとに分けて作っても同じ足になる
+    @staticmethod
+    def tick_bars_cacheable(rule):
+        try:
+            return pandas.Timedelta(days=1) % pandas.Timedelta(rule) == pandas.Timedelta(0)
+        except:
+            return False
+
+    @staticmethod
+    def load_tick_bars(code, start_date, end_date, rule):
+        start = utils.to_datetime(start_date)
+        end = utils.to_datetime(end_date)
+        frames = []
+        month = datetime(start.year, start.month, 1)
+        while month <= end:
+            frames.append(Loader.month_tick_bars(code, month, rule))
+            month = month + relativedelta(months=1)
+
+        bars = Loader.concat(frames)
+        if bars is None:
+            return pandas.DataFrame(columns=["open", "high", "low", "close", "volume"], index=pandas.DatetimeIndex([], name="date"))
+        bars = bars[(start <= bars.index) & (bars.index < end + relativedelta(days=1))]
+
+        # 値のある足の間だけにして、月をまたぐ間の空の足を埋める (まとめてresampleした場合と同じにする)
+        rows = numpy.flatnonzero(bars["open"].notna().to_numpy())
+        if len(rows) == 0:
+            return bars.iloc[0:0]
+        bars = bars.iloc[rows[0]:rows[-1]+1]
+        index = pandas.date_range(bars.index[0], bars.index[-1], freq=rule, name=bars.index.name, unit=bars.index.unit)
+        if len(index) != len(bars):
+            bars = bars.reindex(index)
+            bars["volume"] = bars["volume"].fillna(0)
+        return bars
+
+    # 月ごとの足 (当月より前の月はtick_bars_dirに保存しておく)
+    #   元のティックか日足(寄り付き・大引けの仮のティック)のファイルが変わっていれば作り直す
+    @staticmethod
+    def month_tick_bars(code, month, rule):
+        path = "%s/%s/%s_%s.pickle" % (Loader.tick_bars_dir, code, month.strftime("%Y%m"), rule)
+        completed = month + relativedelta(months=1) <= datetime.now()
+        sources = list(map(cache.file_signature, Loader.month_tick_sources(code, month)))
+
+        if completed and os.path.exists(path):
+            cached = pandas.read_pickle(path)
+            if isinstance(cached, dict) and cached["sources"] == sources:
+                return cached["bars"]
+
+        month_end = month + relativedelta(months=1) - relativedelta(days=1)
+        tick = Loader.load_stock_tick(code, utils.to_format(month), utils.to_format(month_end))
+        bars = None if tick is None else Loader.tick_bars(tick, rule)
+
+        if completed:
+            Loader.write(path, lambda f: pandas.to_pickle({"sources": sources, "bars": bars}, f, compression=None))
+        return bars
+
+    # month_tick_barsの元になるファイル (ティックと日足)
+    @staticmethod
+    def month_tick_sources(code, month):
+        return [
+            "%s/%s/%s.csv" % (Loader.tick_dir, month.strftime("%Y%m"), code),
+            "%s/%s/%s.csv" % (Loader.stock_dir, code, month.year),
+        ]
+
     @staticmethod
     def load_tick_ohlc(code, start_date, end_date, rule="5T", time=None):
         if code in Bitcoin().exchanges:
@@ -227,43 +393,198 @@ class Loader:
 
     @staticmethod
     def years(start_date, end_date):
-        start = 2007
+        start = 2007 if start_date is None else max(2007, pandas.Timestamp(start_date).year)
         end = datetime.strptime(end_date, "%Y-%m-%d").strftime("%Y")
         years = range(int(start), int(end)+1)
         return years
 
+    # load_indexと同じく、cache.content_cacheを設定したときだけキャッシュする
     @staticmethod
     def load(code, start_date, end_date, with_filter=True, strict=False):
-        years = Loader.years(start_date, end_date)
-        data = None
-        for year in years:
-          try:
-            data_ = pandas.read_csv(Loader.stock_dir + '/' + str(code) + '/' + str(year) +  '.csv', header=None)
-            data_ = data_.iloc[:,0:6]
-            data_ = Loader.format(data_, "int")
-          except:
-            continue
-          data = data_ if (data is None) else pandas.concat([data, data_])
+        sources = lambda: Loader.sources(code) + [__file__]
+        return cache.cached("Loader.load", (code, start_date, end_date, with_filter, strict), sources, lambda: Loader.load_uncached(code, start_date, end_date, with_filter, strict))
+
+    @staticmethod
+    def load_uncached(code, start_date, end_date, with_filter=True, strict=False):
+        if Loader.columnar_exists(code):
+            return Loader.load_columnar(code, start_date, end_date, with_filter, strict)
+
+        if with_filter:
+          # 年ごとのファイルなので期間に重なる年だけ読めばよい (strictの判定はファイルの索引で行う)
+          if strict and not Loader.file_index_contains(Loader.file_index(code), start_date, end_date):
+            return None
+          years = Loader.years(start_date, end_date)
+        else:
+          years = Loader.years(None, end_date)
+
+        data = Loader.load_csv(code, years)
         if data is None:
           return None
         if with_filter:
-          filtered = Loader.filter(data, start_date, end_date, strict)
+          filtered = Loader.filter(data, start_date, end_date)
           if len(filtered) == 0:
             return None
           return filtered
         return data
 
+    @staticmethod
+    def load_csv(code, years):
+        return Loader.concat(list(map(lambda year: Loader.load_year(code, year), years)))
+
+    @staticmethod
+    def load_year(code, year):
+        try:
+          data = pandas.read_csv(Loader.stock_dir + '/' + str(code) + '/' + str(year) +  '.csv', header=None)
+          data = data.iloc[:,0:6]
+          data = Loader.format(data, "int")
+        except:
+          data = None
+        return data
+
+    # 一時ファイルに書いてから置き換える (cache.Cache.writeと同じ)
+    #   一時ファイル名はプロセスとスレッドごとに分けるので、同じファイルを並列に書いても混ざらない
+    @staticmethod
+    def write(path, callback, mode="wb"):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = "%s.%s.%s.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp, mode) as f:
+                callback(f)
+            os.replace(temp, path)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    # 銘柄ごとのファイルの索引 {year: {"first": 最初の日付, "last": 最後の日付, "rows": 行数, "mtime": 更新日時}}
+    #   更新されたファイルだけ読み直してfile_index_dirに保存しておく
+    @staticmethod
+    def file_index(code):
+        path = "%s/%s.json" % (Loader.file_index_dir, code)
+        try:
+            with open(path, "r") as f:
+                index = json.load(f)
+        except:
+            index = {}
+
+        stock_brand_dir = "%s/%s" % (Loader.stock_dir, code)
+        csvs = list(os.scandir(stock_brand_dir)) if os.path.isdir(stock_brand_dir) else []
+        csvs = dict(map(lambda x: (x.name.replace(".csv", ""), x), filter(lambda x: x.name.replace(".csv", "").isdigit(), csvs)))
+
+        updated = {}
+        for year, csv in sorted(csvs.items()):
+            mtime = csv.stat().st_mtime
+            if year in index.keys() and index[year]["mtime"] == mtime:
+                updated[year] = index[year]
+                continue
+            data = Loader.load_year(code, year)
+            if data is None or len(data) == 0:
+                updated[year] = {"first": None, "last": None, "rows": 0, "mtime": mtime}
+            else:
+                updated[year] = {"first": utils.to_format(data["date"].min()), "last": utils.to_format(data["date"].max()), "rows": len(data), "mtime": mtime}
+
+        if updated != index:
+            Loader.write(path, lambda f: json.dump(updated, f), "w")
+
+        return dict(map(lambda x: (int(x[0]), x[1]), updated.items()))
+
+    # start_date以前とend_date以降のデータがあるか (Loader.filterのstrict)
+    @staticmethod
+    def file_index_contains(index, start_date, end_date):
+        end_year = pandas.Timestamp(end_date).year
+        files = list(filter(lambda x: x[0] <= end_year and x[1]["rows"] > 0, index.items()))
+        before = any(map(lambda x: pandas.Timestamp(x[1]["first"]) <= pandas.Timestamp(start_date), files))
+        after = any(map(lambda x: pandas.Timestamp(end_date) <= pandas.Timestamp(x[1]["last"]), files))
+        return before and after
+
+    # end_dateまでのデータから期間内 + data_length行を取れるだけの年
+    @staticmethod
+    def file_index_years(index, start_date, end_date, data_length):
+        start_year = pandas.Timestamp(start_date).year
+        end_year = pandas.Timestamp(end_date).year
+        years = list(filter(lambda x: start_year <= x <= end_year, index.keys()))
+        rows = 0
+        for year in sorted(filter(lambda x: x < start_year, index.keys()), reverse=True):
+            if rows >= data_length:
+                break
+            years.append(year)
+            rows += index[year]["rows"]
+        return sorted(years)
+
+    # 日足をカラムごとの.npyに変換する ========
+    #   columnar_dir/<code>/<column>.npy があって元のCSVより新しければLoader.loadはこちらを読む
+    columnar_columns = ["date", "open", "high", "low", "close", "volume"]
+
+    @staticmethod
+    def columnar_path(code, column):
+        return "%s/%s/%s.npy" % (Loader.columnar_dir, code, column)
+
+    @staticmethod
+    def columnar_exists(code):
+        path = Loader.columnar_path(code, "date")
+        if not os.path.exists(path):
+            return False
+
+        stock_brand_dir = "%s/%s" % (Loader.stock_dir, code)
+        csvs = list(os.scandir(stock_brand_dir)) if os.path.isdir(stock_brand_dir) else []
+        updated = max(map(lambda x: x.stat().st_mtime, csvs), default=0)
+        return updated <= os.path.getmtime(path)
+
+    @staticmethod
+    def to_columnar(code):
+        data = Loader.load_csv(code, Loader.years("2007-01-01", utils.to_format(datetime.now())))
+        if data is None:
+            return False
+
+        # dateを最後に書き込む (dateの更新日時で変換済みか判断する)
+        for column in Loader.columnar_columns[1:] + Loader.columnar_columns[:1]:
+            values = data[column].to_numpy()
+            Loader.write(Loader.columnar_path(code, column), lambda f: numpy.save(f, values))
+        return True
+
+    @staticmethod
+    def to_columnar_all(codes=None):
+        codes = sorted(os.listdir(Loader.stock_dir)) if codes is None else codes
+        converted = list(filter(lambda code: Loader.to_columnar(code), codes))
+        print("converted: %s" % len(converted))
+        return converted
+
+    # 期間内の行だけをmmapから読み込む
+    #   CSVと同じくend_dateの年までを対象にし、with_filter=Falseならindexも年ごとのファイルと同じ (年ごとに0から) にする
+    @staticmethod
+    def load_columnar(code, start_date, end_date, with_filter=True, strict=False):
+        date = numpy.load(Loader.columnar_path(code, "date"), mmap_mode="r")
+        end = pandas.Timestamp(end_date).to_datetime64()
+        date = date[:numpy.searchsorted(date, numpy.datetime64("%d-01-01" % (pandas.Timestamp(end_date).year + 1)))]
+
+        if with_filter:
+            start = pandas.Timestamp(start_date).to_datetime64()
+            # start_date ~ end_date の間のデータが欠けている場合データ数が少なくなってしまうため除外する
+            if strict and not ((date <= start).any() and (end <= date).any()):
+                return None
+            rows = numpy.flatnonzero((start <= date) & (date <= end))
+        else:
+            rows = numpy.arange(len(date))
+
+        if len(rows) == 0:
+            return None
+        if rows[-1] - rows[0] + 1 == len(rows):
+            rows = slice(rows[0], rows[-1] + 1)
+
+        data = {}
+        for column in Loader.columnar_columns:
+            values = date if column == "date" else numpy.load(Loader.columnar_path(code, column), mmap_mode="r")
+            data[column] = numpy.array(values[rows])
+
+        if with_filter:
+            return pandas.DataFrame(data, columns=Loader.columnar_columns)
+        years = date.astype("datetime64[Y]")
+        return pandas.DataFrame(data, columns=Loader.columnar_columns, index=numpy.arange(len(date)) - numpy.searchsorted(years, years))
+
     @staticmethod
     def load_all(code):
         stock_brand_dir = "%s/%s" % (Loader.stock_dir, code)
         csvs = sorted(os.listdir(stock_brand_dir))
-        data = None
-        for csv in csvs:
-           try:
-               data_ = pandas.read_csv(stock_brand_dir+"/"+csv, header=None)
-           except:
-               continue
-           data = data_ if (data is None) else pandas.concat([data, data_])
+        data = Loader.concat(list(map(lambda csv: Loader.read_csv(stock_brand_dir+"/"+csv, header=None), csvs)))
         if data is None:
            return None
         data = data.iloc[:,0:6]
@@ -285,7 +606,10 @@ class Loader:
 
     @staticmethod
     def load_by_length(code, start_date, end_date, data_length):
-        data = Loader.load(code, start_date, end_date, with_filter=False)
+        if Loader.columnar_exists(code):
+            data = Loader.load(code, start_date, end_date, with_filter=False)
+        else:
+            data = Loader.load_csv(code, Loader.file_index_years(Loader.file_index(code), start_date, end_date, data_length))
         if data is None:
             return None
         filtered = Loader.filter(data, start_date, end_date)
@@ -297,28 +621,59 @@ class Loader:
         data = data.reset_index(drop=True)
         return data
 
+    # workers: 並列に読み込むプロセス数 (Noneならcpu数)
     @staticmethod
-    def loads(codes, start_date, end_date, strict=False, with_code=True):
+    def loads(codes, start_date, end_date, strict=False, with_code=True, workers=1):
+        loaded = {}
+        elapsed = {}
+        for (code, _, _, _), d, sec in Loader.imap_loads(codes, start_date, end_date, strict, workers):
+            loaded[code] = d
+            elapsed[code] = sec
+
+        # 渡された銘柄の順に並べる
         data = {} if with_code else []
         for code in codes:
-            d = Loader.load(code, start_date, end_date, strict=strict)
+            d = loaded.get(code)
             if d is None:
                 continue
             if with_code:
                 data[code] = d
             else:
                 data.append(d)
-        print("load: %s" % len(data))
+
+        if workers == 1:
+            print("load: %s" % len(data))
+        else:
+            slowest = max(elapsed.items(), key=lambda x: x[1], default=(None, 0))
+            print("load: %s (total: %.2fs, slowest: %s %.2fs)" % (len(data), sum(elapsed.values()), slowest[0], slowest[1]))
         return data
 
+    # 読み込みを並列に行い、終わった順に ((code, start_date, end_date, strict), data, 秒) を返す
     @staticmethod
-    def load_with_realtime(code, start_date, end_date):
+    def imap_loads(codes, start_date, end_date, strict=False, workers=None, buffer=2):
+        params = map(lambda code: (code, start_date, end_date, strict), codes)
+        return utils.parallel_imap(load_by_params, params, workers, buffer)
+
+    # codeの元になるファイル
+    @staticmethod
+    def sources(code):
         if str(code).isdigit():
-            data = Loader.load(code, start_date, end_date)
+            return ["%s/%s" % (Loader.stock_dir, code), "%s/%s" % (Loader.columnar_dir, code)]
+        elif "_" in str(code):
+            name, month, session = str(code).split("_")
+            return ["%s/%s/%s_%s.csv" % (Loader.futures_dir, name, month, session)]
+        else:
+            return [Loader.base_dir + "/index/" + str(code) + ".csv"]
+
+    # cached=Falseならcache.cachedを通さない (読み込んだ結果を加工してキャッシュする呼び出し元向け)
+    @staticmethod
+    def load_with_realtime(code, start_date, end_date, cached=True):
+        if str(code).isdigit():
+            data = Loader.load(code, start_date, end_date) if cached else Loader.load_uncached(code, start_date, end_date)
         elif "_" in str(code):
             data = Loader.load_futures(code, start_date, end_date)
         else:
-            data = Loader.load_index(code, start_date, end_date)
+            data = Loader.load_index(code, start_date, end_date) if cached else Loader.load_index_uncached(code, start_date, end_date)
 
         if data is None:
             raise Exception("%s: %s - %s not found" % (code, start_date, end_date))
@@ -411,19 +766,17 @@ class Loader:
         data = Loader.load_realtime_ohlc(code, date, rule=rule) # 今日の分
         if time is not None:
             data = data[data["date"] <= "%s %s" % (date, time)]
-        length = 1
-        current = date
-        while length < days:
-            current = utils.to_format(utils.to_datetime(current) - relativedelta(days=1))
-            if utils.is_weekday(utils.to_datetime(current)):
-                if is_stock:
-                    d = Loader.load_realtime_minutes(code, current)
-                else:
-                    d = Loader.load_realtime_ohlc(code, current)
-                if d is not None:
-                    d = Loader.resample(d, rule=rule)
-                    data = pandas.concat([d, data])
-                length = length + 1
+        frames = [data]
+        for n in range(1, days):
+            current = utils.to_format(utils.trading_calendar().previous(utils.to_datetime(date), n))
+            if is_stock:
+                d = Loader.load_realtime_minutes(code, current)
+            else:
+                d = Loader.load_realtime_ohlc(code, current)
+            if d is not None:
+                d = Loader.resample(d, rule=rule)
+                frames.append(d)
+        data = pandas.concat(list(reversed(frames))) if len(frames) > 1 else data
         if is_stock:
             data = Loader.zaraba_filter(data)
         return data
@@ -446,15 +799,11 @@ class Loader:
 
     @staticmethod
     def zaraba_filter(data):
-        data = data[
-            (data["date"].dt.hour >= 9) & (data["date"].dt.hour <= 10) |
-            (data["date"].dt.hour >= 13) & (data["date"].dt.hour <= 14) |
-            (data["date"].dt.hour == 11) & (data["date"].dt.minute <= 30) |
-            (data["date"].dt.hour == 12) & (data["date"].dt.minute >= 30) |
-            (data["date"].dt.hour == 8) & (data["date"].dt.minute == 59)
-        ]
-        data = data.reset_index()
-        return data
+        return Loader.session_filter(data, "stock")
+
+    @staticmethod
+    def session_filter(data, market):
+        return Loader.sessions[market].filter(data)
 
     @staticmethod
     def stocks():
@@ -730,9 +1079,7 @@ class Loader:
     @staticmethod
     def before_ranking(date, ranking_type, before=1):
         d = utils.to_datetime(date) - utils.relativeterm(before, with_time=True)
-        while not utils.is_weekday(d):
-            d = d - utils.relativeterm(1, with_time=True)
-        d = utils.to_format(d)
+        d = utils.to_format(utils.select_weekday(d))
         stocks = Loader.ranking(d, ranking_type)
         return stocks
 
@@ -867,3 +1214,6 @@ class Loader:
             traceback.print_exc()
             data = None
 
+def load_by_params(params):
+    code, start_date, end_date, strict = params
+    return Loader.load(code, start_date, end_date, strict=strict)
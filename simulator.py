@@ -5,30 +5,46 @@ import random
 import pandas
 import utils
 import copy
+import weakref
 import math
 from itertools import groupby
+from multiprocessing import shared_memory
 
 # 売買の状態
 class Position:
+    __slots__ = ("num", "total", "units", "first", "initial", "term", "system", "method", "min_unit")
+
     def __init__(self, num = 0, value = 0, term = 0, initial = None, system="actual", method="long", min_unit=None):
         assert min_unit is not None, "min_unit is None."
         self.num = int(num)
-        self.value = []
+        self.clear_value()
         self.initial = initial
         if value != 0:
-            self.value = [value]
+            self.add_value(value, 1)
         self.term = term # 保有期間
         self.system = system
         self.method = method
         self.min_unit = min_unit
 
+    # 平均取得価格の計算のため取得価格の合計と単位数だけ持つ
+    def add_value(self, value, units):
+        if self.units == 0:
+            self.first = value
+        self.total += value * units
+        self.units += units
+
+    def clear_value(self):
+        self.total = 0
+        self.units = 0
+        self.first = None
+
     def add_history(self, num, value):
-        for _ in range(int(num)):
-            self.value.append(value) # 平均取得価格の計算のため
+        if int(num) > 0:
+            self.add_value(value, int(num))
         self.num += num
         if self.get_num() == 0:
           self.term = 0
-          self.value = []
+          self.clear_value()
 
     # 現在の評価額
     def eval(self, value, num):
@@ -51,7 +67,7 @@ class Position:
 
     # 返済
     def repay(self, num, value):
-        assert len(self.value) > 0, "do not repay. not hold."
+        assert self.units > 0, "do not repay. not hold."
         price = self.cost(value, num)
         self.add_history(-num, value)
         return price
@@ -62,17 +78,14 @@ class Position:
 
     # 平均取得価格
     def get_value(self):
-        if len(self.value) == 0:
+        if self.units == 0:
             return 0
-        return sum(self.value) / len(self.value)
+        return self.total / self.units
 
     # ポジション取得時の価格
     def get_initial(self):
         if self.initial is None:
-            if len(self.value) > 0:
-                return self.value[0]
-            else:
-                return None
+            return self.first
         return self.initial
 
     # 損益
@@ -205,11 +218,61 @@ class AppliableData:
     def at(self, date):
         return AppliableData(self.data.at(date), self.index.at(date), self.position, self.assets, self.setting, self.stats)
 
+# 日付順に並んだデータの対象日までの位置を保持する
+class SimulatorCursor:
+    def __init__(self, dates, inclusive=True):
+        self.dates = dates
+        self.side = "right" if inclusive else "left" # Falseなら対象日を含まない
+        self.position = 0
+        self.current = None
+
+    def key(self, date):
+        if numpy.issubdtype(self.dates.dtype, numpy.datetime64):
+            return numpy.datetime64(pandas.Timestamp(date)).astype(self.dates.dtype)
+        return date
+
+    # 対象日までのデータ数
+    def seek(self, date):
+        key = self.key(date)
+        # 日付が戻った場合は先頭から探し直す
+        if self.current is not None and key < self.current:
+            self.position = 0
+        self.position = self.position + numpy.searchsorted(self.dates[self.position:], key, side=self.side).item()
+        self.current = key
+        return self.position
+
 class SimulatorData:
     def __init__(self, code, daily, rule):
         self.code = code
         self.daily = daily
         self.rule = rule
+        self.array = None
+
+    # 日付順に並んでいなければカーソルは使えない
+    def cursor(self, inclusive=True):
+        if not self.daily["date"].is_monotonic_increasing:
+            return None
+        return SimulatorCursor(self.daily["date"].values, inclusive)
+
+    def split_by_cursor(self, cursor, date):
+        return self.index(0, cursor.seek(date))
+
+    def length(self):
+        return len(self.daily)
+
+    # n本前の値 (iloc[-n]と同じ)
+    def last(self, column, n=1):
+        return self.daily[column].iloc[-n]
+
+    # 直近n本の値 (iloc[-n:]と同じ)
+    def window(self, column, n):
+        return self.daily[column].iloc[-n:]
+
+    # 変換結果は使いまわす
+    def to_array(self):
+        if self.array is None:
+            self.array = SimulatorArrayData(self.code, self.daily, self.rule)
+        return self.array
 
     def split(self, start_date, end_date):
         data = self.split_from(start_date).split_to(end_date)
@@ -246,12 +309,156 @@ class SimulatorData:
         data['date'] = pandas.to_datetime(data['date'], format='%Y-%m-%d')
         return SimulatorData(self.code, pandas.DataFrame([[0] * len(self.daily.columns)], columns=self.daily.columns), self.rule)
 
+# 列ごとの連続したnumpy配列で保持するデータ
+#   同じ配列を共有したまま末尾の位置(end)だけを変えて切り出す
+class SimulatorArrayData(SimulatorData):
+    def __init__(self, code, daily, rule, columns=None, end=None, matrices=None):
+        self.code = code
+        self.source = daily
+        self.rule = rule
+        self.columns = self.to_columns(daily) if columns is None else columns
+        self.end = len(daily) if end is None else end
+        self.matrices = weakref.WeakKeyDictionary() if matrices is None else matrices # 指標データ -> 条件の判定結果 (strategy.ConditionMatrix)
+
+    # 判定結果は弱参照なのでpickleせずに作り直す
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["matrices"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.matrices = weakref.WeakKeyDictionary()
+
+    def to_columns(self, daily):
+        columns = {}
+        for column in daily.columns:
+            columns[column] = numpy.ascontiguousarray(daily[column].to_numpy())
+        return columns
+
+    # 既存のコード向けにDataFrameも返す
+    @property
+    def daily(self):
+        return self.source.iloc[:self.end]
+
+    def cursor(self, inclusive=True):
+        return self.full_cursor(self.columns["date"][:self.end], inclusive)
+
+    # 切り出す前の全期間のカーソル
+    def full_cursor(self, dates=None, inclusive=True):
+        dates = self.columns["date"] if dates is None else dates
+        if len(dates) > 1 and not (dates[1:] >= dates[:-1]).all():
+            return None
+        return SimulatorCursor(dates, inclusive)
+
+    def index(self, begin, end):
+        if begin != 0 or end is None or end < 0:
+            return super().index(begin, end)
+        return SimulatorArrayData(self.code, self.source, self.rule, self.columns, min(end, self.end), self.matrices)
+
+    def length(self):
+        return self.end
+
+    def last(self, column, n=1):
+        value = self.columns[column][:self.end][-n]
+        if isinstance(value, numpy.datetime64):
+            return pandas.Timestamp(value)
+        return value
+
+    def window(self, column, n):
+        return SimulatorWindow(self.columns[column][:self.end][-n:])
+
+    def to_array(self):
+        return self
+
+    def to_vector(self):
+        return SimulatorVectorData(self.columns, numpy.arange(1, len(self.columns["date"]) + 1))
+
+    # datesの各日付で参照できるデータ
+    def to_vector_by_dates(self, dates, inclusive=True):
+        cursor = self.full_cursor(inclusive=inclusive)
+        if cursor is None or not numpy.issubdtype(cursor.dates.dtype, numpy.datetime64):
+            return None
+        positions = numpy.searchsorted(cursor.dates, dates.astype(cursor.dates.dtype), side=cursor.side)
+        return SimulatorVectorData(self.columns, positions, complement=True)
+
+# 直近n本の値の集計
+#   pandas.Seriesと同じくNaNを除いて集計する (値がなければmin/maxはNaN, sumは0)
+class SimulatorWindow:
+    def __init__(self, values):
+        self.values = values
+
+    def valid(self):
+        if self.values.dtype.kind != "f":
+            return self.values
+        return self.values[~numpy.isnan(self.values)]
+
+    def min(self):
+        values = self.valid()
+        return values.min() if len(values) > 0 else numpy.nan
+
+    def max(self):
+        values = self.valid()
+        return values.max() if len(values) > 0 else numpy.nan
+
+    def sum(self):
+        return self.valid().sum()
+
+# 全期間をまとめて判定するためのデータ
+#   last/windowが各日の値を並べた配列を返すので、条件をそのまま渡すと日数分の判定結果になる
+class SimulatorVectorData:
+    def __init__(self, columns, positions, complement=False):
+        self.columns = columns
+        self.positions = positions # 各日で参照できるデータ数
+        self.complement = complement # データがない日は0で埋める (SimulatorIndexData.complement)
+
+    def gather(self, values, index, empty, missing=numpy.nan):
+        result = numpy.full(len(index), missing)
+        valid = index >= 0
+        result[valid] = values[index[valid]]
+        if self.complement:
+            result[self.positions == 0] = empty
+        return result
+
+    def last(self, column, n=1):
+        return self.gather(self.columns[column], self.positions - n, 0 if n == 1 else numpy.nan)
+
+    def window(self, column, n):
+        return SimulatorVectorWindow(self, column, n)
+
+class SimulatorVectorWindow:
+    def __init__(self, data, column, n):
+        self.data = data
+        self.column = column
+        self.n = n
+
+    # SimulatorWindowと同じくNaNを除いて集計する
+    def apply(self, method):
+        series = pandas.Series(self.data.columns[self.column], dtype="f8")
+        rolling = series.rolling(self.n, min_periods=1) if self.n > 0 else series.expanding(min_periods=1)
+        values = getattr(rolling, method)().values
+        if method != "sum":
+            return self.data.gather(values, self.data.positions - 1, 0)
+        values = numpy.where(rolling.count().values > 0, values, 0)
+        return self.data.gather(values, self.data.positions - 1, 0, missing=0)
+
+    def min(self):
+        return self.apply("min")
+
+    def max(self):
+        return self.apply("max")
+
+    def sum(self):
+        return self.apply("sum")
+
 class SimulatorIndexData:
-    def __init__(self, data):
+    def __init__(self, data, source=None):
         self.data = data
+        self.source = source # 切り出し元 (split_by_cursors)
+        self.array = None
 
     def complement(self, data, date):
-        return data if len(data.daily) > 0 else data.create_empty(date)
+        return data if data.length() > 0 else data.create_empty(date)
 
     def dates(self, start_date, end_date):
         dates = []
@@ -266,22 +473,153 @@ class SimulatorIndexData:
             term_index[k] = v.split_from(date)
         return SimulatorIndexData(term_index)
 
+    # 前日までのデータを使う指標
+    def is_until(self, key):
+        return key in ["dow", "nasdaq"]
+
     def split_to(self, date):
         term_index = {}
         for k, v in self.data.items():
-            if k in ["dow", "nasdaq"]:
+            if self.is_until(k):
                 d = v.split_until(date)
             else:
                 d = v.split_to(date)
             term_index[k] = self.complement(d, date)
         return SimulatorIndexData(term_index)
 
+    def cursors(self):
+        cursors = {}
+        for k, v in self.data.items():
+            cursors[k] = v.cursor(inclusive=not self.is_until(k))
+        return cursors
+
+    def split_by_cursors(self, cursors, date):
+        term_index = {}
+        for k, v in self.data.items():
+            if cursors[k] is None:
+                d = v.split_until(date) if self.is_until(k) else v.split_to(date)
+            else:
+                d = v.split_by_cursor(cursors[k], date)
+            term_index[k] = self.complement(d, date)
+        return SimulatorIndexData(term_index, self)
+
     def split(self, start_date, end_date):
         return self.split_from(start_date).split_to(end_date)
 
     def at(self, date):
         return self.split_from(date).split_to(date)
 
+    # 変換結果は使いまわす
+    def to_array(self):
+        if self.array is None:
+            data = {}
+            for k, v in self.data.items():
+                data[k] = v.to_array()
+            self.array = SimulatorIndexData(data)
+            self.array.array = self.array
+        return self.array
+
+    # 日付順に並んでいない指標は含まない
+    def to_vector(self, dates):
+        data = {}
+        for k, v in self.data.items():
+            d = v.to_array().to_vector_by_dates(dates, inclusive=not self.is_until(k))
+            if d is not None:
+                data[k] = d
+        return SimulatorIndexData(data)
+
+# 銘柄と指標のデータを共有メモリに置いてプロセス間で使いまわす
+#   ワーカーには名前と配置だけを渡し、attachで共有メモリ上の配列をそのまま参照するデータを作る
+class SimulatorSharedData:
+    def __init__(self, name, layout, memory=None):
+        self.name = name
+        self.layout = layout # {"data": {code: (rule, columns)}, "index": {key: (rule, columns)}}
+        self.memory = memory
+
+    def __getstate__(self):
+        return {"name": self.name, "layout": self.layout, "memory": None}
+
+    @staticmethod
+    def to_columns(data):
+        return data.to_array().columns
+
+    @staticmethod
+    def publish(stocks, index):
+        targets = {
+            "data": dict(map(lambda x: (x[0], x[1]), stocks.items())),
+            "index": dict(map(lambda x: (x[0], x[1]), index.data.items())),
+        }
+
+        # 配置を決める (数値と日付は共有メモリ, 文字列などはpickleで渡す)
+        layout = {}
+        size = 0
+        for kind, data in targets.items():
+            layout[kind] = {}
+            for key, d in data.items():
+                columns = {}
+                for column, values in SimulatorSharedData.to_columns(d).items():
+                    if values.dtype.hasobject:
+                        columns[column] = values
+                        continue
+                    size = int(math.ceil(size / 8) * 8)
+                    columns[column] = (size, values.dtype.str, values.shape)
+                    size += values.nbytes
+                layout[kind][key] = (d.rule, columns)
+
+        memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for kind, data in targets.items():
+            for key, d in data.items():
+                for column, values in SimulatorSharedData.to_columns(d).items():
+                    spec = layout[kind][key][1][column]
+                    if isinstance(spec, tuple):
+                        SimulatorSharedData.view(memory, spec)[:] = values
+
+        return SimulatorSharedData(memory.name, layout, memory)
+
+    @staticmethod
+    def view(memory, spec):
+        offset, dtype, shape = spec
+        return numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=memory.buf, offset=offset)
+
+    def create(self, code, rule, specs):
+        columns = {}
+        for column, spec in specs.items():
+            if isinstance(spec, tuple):
+                values = self.view(self.memory, spec)
+                values.flags.writeable = False # 他のプロセスと共有しているので書き換えない
+                columns[column] = values
+            else:
+                columns[column] = spec
+        daily = pandas.DataFrame(columns, copy=False)
+        return SimulatorArrayData(code, daily, rule, columns)
+
+    # 共有メモリ上のデータを参照する (stocks, index)
+    def attach(self):
+        if self.memory is None:
+            self.memory = shared_memory.SharedMemory(name=self.name)
+
+        stocks = {}
+        for code, (rule, specs) in self.layout["data"].items():
+            stocks[code] = self.create(code, rule, specs)
+
+        index = {}
+        for key, (rule, specs) in self.layout["index"].items():
+            index[key] = self.create(key, rule, specs)
+
+        return stocks, SimulatorIndexData(index)
+
+    def close(self):
+        if self.memory is not None:
+            self.memory.close()
+            self.memory = None
+
+    # 作成したプロセスで最後に呼ぶ
+    def unlink(self):
+        memory = shared_memory.SharedMemory(name=self.name) if self.memory is None else self.memory
+        memory.unlink()
+        memory.close()
+        self.memory = None
+
 # シミュレーター設定
 class SimulatorSetting:
     def __init__(self):
@@ -301,11 +639,110 @@ class SimulatorSetting:
         self.use_before_stick = False
         self.auto_stop_loss = None
         self.ignore_volume = False # 指値時の出来高チェックをスキップ
+        self.use_cursor = True # 日付のカーソルで対象日までのデータを切り出す
+        self.use_array_data = True # 列ごとのnumpy配列に変換して条件判定を速くする
+        self.use_condition_matrix = True # 条件の判定結果を全期間まとめて計算しておく (use_array_dataが必要)
+
+# トレード履歴 (項目ごとの配列に保持して足りなくなったら倍に広げる)
+class SimulatorTradeHistory:
+    fields = {
+        "date": object,
+        "new": numpy.float64,
+        "repay": numpy.float64,
+        "signal": object,
+        "new_order": object,
+        "repay_order": object,
+        "closing_order": object,
+        "gain": numpy.float64,
+        "gain_rate": numpy.float64,
+        "assets": numpy.float64,
+        "min_assets": numpy.float64,
+        "unavailable_assets": numpy.float64,
+        "term": numpy.float64,
+        "size": numpy.float64,
+        "canceled": object,
+        "contract_price": numpy.float64,
+        "order_type": object,
+        "commission": numpy.float64,
+    }
+
+    def __init__(self, capacity=256):
+        self.size = 0
+        self.columns = {}
+        self.integers = {} # 整数が入っている位置 (取り出すときに整数に戻す)
+        for name, dtype in self.fields.items():
+            self.columns[name] = numpy.empty(capacity, dtype=dtype)
+            if dtype == numpy.float64:
+                self.integers[name] = numpy.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return self.size
+
+    def grow(self):
+        for name, values in self.columns.items():
+            columns = numpy.empty(len(values) * 2, dtype=values.dtype)
+            columns[:self.size] = values[:self.size]
+            self.columns[name] = columns
+        for name, values in self.integers.items():
+            integers = numpy.zeros(len(values) * 2, dtype=bool)
+            integers[:self.size] = values[:self.size]
+            self.integers[name] = integers
+
+    # Noneはnanで持つ
+    def write(self, i, trade_data):
+        for name, values in self.columns.items():
+            value = trade_data[name]
+            if values.dtype != numpy.float64:
+                values[i] = value
+            elif value is None:
+                values[i] = numpy.nan
+                self.integers[name][i] = False
+            else:
+                values[i] = value
+                self.integers[name][i] = isinstance(value, (int, numpy.integer))
+
+    def append(self, trade_data):
+        if self.size == len(self.columns["date"]):
+            self.grow()
+        self.write(self.size, trade_data)
+        self.size += 1
+
+    # 最後の行を書き換える
+    def update(self, trade_data):
+        self.write(self.size - 1, trade_data)
+
+    def column(self, name):
+        return self.columns[name][:self.size]
+
+    def values(self, name):
+        values = self.column(name)
+        if values.dtype != numpy.float64:
+            return values.tolist()
+        integers = self.integers[name][:self.size].tolist()
+        return list(map(lambda x: None if math.isnan(x[0]) else int(x[0]) if x[1] else x[0], zip(values.tolist(), integers)))
+
+    def to_list(self):
+        columns = list(map(lambda x: (x, self.values(x)), self.fields.keys()))
+        return list(map(lambda i: dict(map(lambda x: (x[0], x[1][i]), columns)), range(self.size)))
+
+    def to_dataframe(self):
+        return pandas.DataFrame(dict(map(lambda x: (x, self.column(x)), self.fields.keys())))
 
 # 統計
 class SimulatorStats:
     def __init__(self):
-        self.trade_history = []
+        self.history = SimulatorTradeHistory()
+        self.current_data = None # 当日の履歴 (applyまで書き換わる)
+        # 確定した履歴(最後の1件以外)の集計 最後の1件は当日中に書き換わるので都度足し合わせる
+        self.peak_assets = None
+        self.drawdowns = []
+        self.max_committed_drawdown = None
+        self.gains = []
+        self.gain_sum = 0
+        self.win_num = 0
+        self.lose_num = 0
+        self.committed_streak = None
+        self.auto_stop_loss_count = 0
 
     def create_trade_data(self):
         trade_data = {
@@ -331,16 +768,73 @@ class SimulatorStats:
         return trade_data
 
     def append(self, trade_data):
-        self.trade_history.append(trade_data)
+        if self.current_data is not None:
+            self.history.update(self.current_data)
+            self.commit(self.current_data)
+        self.current_data = trade_data
+        self.history.append(trade_data)
+
+    def flush(self):
+        if self.current_data is not None:
+            self.history.update(self.current_data)
+
+    # 既存のコード向けに辞書のリストでも返す
+    @property
+    def trade_history(self):
+        self.flush()
+        return self.history.to_list()
+
+    def values(self, name):
+        self.flush()
+        return self.history.values(name)
+
+    # 前日までの履歴を集計に反映する
+    def commit(self, trade_data):
+        drawdown = self.current_drawdown(trade_data)
+        self.peak_assets = self.next_peak(trade_data)
+        self.drawdowns.append(drawdown)
+        self.max_committed_drawdown = drawdown if self.max_committed_drawdown is None else max(self.max_committed_drawdown, drawdown)
+
+        gain = trade_data["gain"]
+        if gain is not None:
+            self.gains.append(gain)
+            self.gain_sum += gain
+            self.win_num += 1 if gain > 0 else 0
+            self.lose_num += 1 if gain < 0 else 0
+            self.committed_streak = self.next_streak(gain)
+
+        if self.is_auto_stop_loss(trade_data):
+            self.auto_stop_loss_count += 1
+
+    def next_peak(self, trade_data):
+        return trade_data["assets"] if self.peak_assets is None else max(self.peak_assets, trade_data["assets"])
+
+    def current_drawdown(self, trade_data):
+        peak = self.next_peak(trade_data)
+        return (numpy.float64(peak - trade_data["assets"]) / peak).item()
+
+    def next_streak(self, gain):
+        is_win = gain > 0
+        if self.committed_streak is None or self.committed_streak[0] != is_win:
+            return (is_win, 1)
+        return (is_win, self.committed_streak[1] + 1)
+
+    def current(self):
+        return self.current_data
+
+    def current_gain(self):
+        current = self.current()
+        return None if current is None else current["gain"]
 
     def apply(self, trade_data):
-        self.trade_history = self.trade_history[:-1] + [trade_data]
+        self.current_data = trade_data
+        self.history.update(trade_data)
 
     def size(self):
-        return list(map(lambda x: x["size"], self.trade_history))
+        return self.values("size")
 
     def term(self):
-        return list(map(lambda x: x["term"], self.trade_history))
+        return self.values("term")
 
     def max_size(self):
         return max(self.size()) if len(self.size()) > 0 else 0
@@ -358,13 +852,15 @@ class SimulatorStats:
         return list(filter(lambda x: x["gain"] < 0, self.trade()))
 
     def trade_num(self):
-        return len(self.trade())
+        return len(self.gains) + (0 if self.current_gain() is None else 1)
 
     def win_trade_num(self):
-        return len(self.win_trade())
+        gain = self.current_gain()
+        return self.win_num + (1 if gain is not None and gain > 0 else 0)
 
     def lose_trade_num(self):
-        return len(self.lose_trade())
+        gain = self.current_gain()
+        return self.lose_num + (1 if gain is not None and gain < 0 else 0)
 
     # 勝率
     def win_rate(self):
@@ -374,10 +870,10 @@ class SimulatorStats:
         return self.win_trade_num() / float(trade_num)
 
     def assets(self):
-        return list(map(lambda x: x["assets"], self.trade_history))
+        return self.values("assets")
 
     def min_assets(self):
-        return list(map(lambda x: x["min_assets"], self.trade_history))
+        return self.values("min_assets")
 
     def max_assets(self):
         if len(self.assets()) == 0:
@@ -385,7 +881,7 @@ class SimulatorStats:
         return max(self.assets())
 
     def unavailable_assets(self):
-        return list(map(lambda x: x["unavailable_assets"], self.trade_history))
+        return self.values("unavailable_assets")
 
     def max_unavailable_assets(self):
         if len(self.unavailable_assets()) == 0:
@@ -393,34 +889,47 @@ class SimulatorStats:
         return max(self.unavailable_assets())
 
     def contract_price(self):
-        return list(map(lambda x: x["contract_price"], self.trade_history))
+        return self.values("contract_price")
 
     def sum_contract_price(self):
         return sum(list(filter(lambda x: x is not None, self.contract_price())))
 
     def drawdown(self):
-        assets = numpy.array(self.assets())
-        max_assets = numpy.maximum.accumulate(assets)
-        drawdown = max_assets - assets
-        drawdown = drawdown / max_assets
+        return self.recent_drawdown(len(self.history))
 
-        return drawdown.tolist()
+    # 直近n件のドローダウン
+    def recent_drawdown(self, n):
+        current = self.current()
+        if current is None or n <= 0:
+            return []
+        committed = self.drawdowns[-(n-1):] if n > 1 else []
+        return committed + [self.current_drawdown(current)]
 
     # 最大ドローダウン
     def max_drawdown(self):
-        dd = self.drawdown()
-        if len(dd) == 0:
+        current = self.current()
+        if current is None:
             return 0
-        return max(dd)
+        drawdown = self.current_drawdown(current)
+        return drawdown if self.max_committed_drawdown is None else max(self.max_committed_drawdown, drawdown)
 
     def gain(self):
-        return list(filter(lambda x: x is not None, map(lambda x: x["gain"], self.trade_history)))
+        gain = self.current_gain()
+        return self.gains + ([] if gain is None else [gain])
+
+    def sum_gain(self):
+        gain = self.current_gain()
+        return self.gain_sum + (0 if gain is None else gain)
+
+    def last_gain(self):
+        gain = self.current_gain()
+        return gain if gain is not None else self.gains[-1] if len(self.gains) > 0 else None
 
     def gain_rate(self):
-        return list(filter(lambda x: x is not None, map(lambda x: x["gain_rate"], self.trade_history)))
+        return list(filter(lambda x: x is not None, self.values("gain_rate")))
 
     def commission(self):
-        return list(filter(lambda x: x is not None, map(lambda x: x["commission"], self.trade_history)))
+        return list(filter(lambda x: x is not None, self.values("commission")))
 
     def profits(self):
         return list(filter(lambda x: x > 0, self.gain()))
@@ -435,21 +944,25 @@ class SimulatorStats:
         return list(filter(lambda x: x < 0, self.gain_rate()))
 
     def win_streak(self):
-        streak = self.streak()
-        if len(streak) == 0:
+        streak = self.current_streak()
+        if streak is None:
             return 0
         else:
-            is_win, count = streak[-1]
+            is_win, count = streak
             return count if is_win else 0 # 連勝のみ
 
     def lose_streak(self):
-        streak = self.streak()
-        if len(streak) == 0:
+        streak = self.current_streak()
+        if streak is None:
             return 0
         else:
-            is_win, count = streak[-1]
+            is_win, count = streak
             return count if not is_win else 0 # 連勝のみ
 
+    def current_streak(self):
+        gain = self.current_gain()
+        return self.committed_streak if gain is None else self.next_streak(gain)
+
     # 勝敗の連続数
     def streak(self):
         return [ (is_win, len(list(l))) for is_win, l in groupby(self.gain(), key=lambda x: x > 0)]
@@ -479,27 +992,27 @@ class SimulatorStats:
         return reword / risk if risk > 0 else reword
 
     def canceled(self):
-        return self.trade_history[-1]["canceled"] is not None
+        return self.current_data["canceled"] is not None
 
     def new_canceled(self):
-        return self.trade_history[-1]["canceled"] == "new"
+        return self.current_data["canceled"] == "new"
 
     def repay_canceled(self):
-        return self.trade_history[-1]["canceled"] == "repay"
+        return self.current_data["canceled"] == "repay"
 
     def all_canceled(self):
-        return self.trade_history[-1]["canceled"] == "all"
+        return self.current_data["canceled"] == "all"
 
     def new_orders(self):
-        order = self.trade_history[-1]["new_order"]
+        order = self.current_data["new_order"]
         return [] if order is None else [order]
 
     def repay_orders(self):
-        order = self.trade_history[-1]["repay_order"]
+        order = self.current_data["repay_order"]
         return [] if order is None else [order]
 
     def closing_orders(self):
-        order = self.trade_history[-1]["closing_order"]
+        order = self.current_data["closing_order"]
         return [] if order is None else [order]
 
     def orders(self):
@@ -508,8 +1021,15 @@ class SimulatorStats:
     def executed(self):
         return list(filter(lambda x: x["new"] is not None or x["repay"] is not None, self.trade_history))
 
+    def is_auto_stop_loss(self, trade_data):
+        return trade_data["repay"] is not None and trade_data["order_type"] == "reverse_limit"
+
     def auto_stop_loss(self):
-        return list(filter(lambda x: x["repay"] is not None and x["order_type"] == "reverse_limit", self.trade_history))
+        return list(filter(lambda x: self.is_auto_stop_loss(x), self.trade_history))
+
+    def auto_stop_loss_num(self):
+        current = self.current()
+        return self.auto_stop_loss_count + (1 if current is not None and self.is_auto_stop_loss(current) else 0)
 
 # シミュレーター
 class Simulator:
@@ -526,6 +1046,7 @@ class Simulator:
         self.repay_orders = []
         self.closing_orders = []
         self.force_stop = False
+        self.cursor = None
 
     def log(self, message):
         if self.setting.debug:
@@ -542,7 +1063,7 @@ class Simulator:
         return results
 
     def create_appliable_data(self, data, index):
-        return AppliableData(data, index, self.position, self.total_assets(data.daily["close"].iloc[-1].item()), self.setting, self.stats)
+        return AppliableData(data, index, self.position, self.total_assets(data.last("close").item()), self.setting, self.stats)
 
     # 総資産
     def total_assets(self, value):
@@ -866,7 +1387,7 @@ class Simulator:
 
     def order_adjust(self, trade_data):
         # 手仕舞いの場合全部キャンセル
-        if self.position.get_num() > 0 and len(self.closing_orders) > 0 or len(self.stats.auto_stop_loss()) > 2:
+        if self.position.get_num() > 0 and len(self.closing_orders) > 0 or self.stats.auto_stop_loss_num() > 2:
             self.log("[cancel] new/repay order. force closed")
             self.new_orders = []
             self.repay_orders = []
@@ -894,7 +1415,7 @@ class Simulator:
         return trade_data
 
     def simulate(self, dates, data, index={}):
-        assert type(data) is SimulatorData, "data is not SimulatorData."
+        assert isinstance(data, SimulatorData), "data is not SimulatorData."
 
         print(dates)
         for date in dates:
@@ -909,24 +1430,47 @@ class Simulator:
 
         return stats
 
-    # 高速化
-    def simulate_by_date(self, date, data, index={}):
-        term_data = data.split_to(date)
+    # 対象日までのデータ
+    def split_to(self, date, data, index):
+        if not self.setting.use_cursor:
+            return data.split_to(date), index.split_to(date)
+
+        # 前回と同じデータならカーソルを進めるだけ
+        if self.cursor is None or self.cursor["data"] is not data or self.cursor["index"] is not index:
+            array_data = data.to_array() if self.setting.use_array_data else data
+            array_index = index.to_array() if self.setting.use_array_data else index
+            self.cursor = {
+                "data": data,
+                "index": index,
+                "array_data": array_data,
+                "array_index": array_index,
+                "data_cursor": array_data.cursor(),
+                "index_cursors": array_index.cursors()
+            }
+
+        if self.cursor["data_cursor"] is None:
+            term_data = data.split_to(date)
+        else:
+            term_data = self.cursor["array_data"].split_by_cursor(self.cursor["data_cursor"], date)
 
-        term_index = index.split_to(date)
+        term_index = self.cursor["array_index"].split_by_cursors(self.cursor["index_cursors"], date)
 
-        today = term_data.daily.iloc[-1]
+        return term_data, term_index
+
+    # 高速化
+    def simulate_by_date(self, date, data, index={}):
+        term_data, term_index = self.split_to(date, data, index)
 
-        assert len(today) > 0, "not found %s data" % date
+        assert term_data.length() > 0, "not found %s data" % date
 
-        price = today["open"].item() # 約定価格
-        volume = None if self.setting.ignore_volume else math.ceil(today["volume"].item() * 10)
+        price = term_data.last("open").item() # 約定価格
+        volume = None if self.setting.ignore_volume else math.ceil(term_data.last("volume").item() * 10)
         self.log("date: %s, price: %s, volume: %s" % (date, price, volume))
 
         self.trade(self.setting.strategy, price, volume, term_data, term_index)
 
     def open_trade(self, volume, data, trade_data):
-        price = data.daily["open"].iloc[-1].item()
+        price = data.last("open").item()
         # 仮想トレードなら注文をキューから取得
 
         new_orders = []
@@ -939,7 +1483,7 @@ class Simulator:
         return self.virtual_trade(data, new_orders, repay_orders, trade_data)
 
     def close_trade(self, volume, data, trade_data):
-        price = data.daily["close"].iloc[-1].item()
+        price = data.last("close").item()
         # 仮想トレードなら注文をキューから取得
 
         new_orders = []
@@ -953,10 +1497,10 @@ class Simulator:
         return self.virtual_trade(data, new_orders, repay_orders, trade_data)
 
     def intraday_trade(self, volume, data, trade_data):
-        price = data.daily["open"].iloc[-1].item()
+        price = data.last("open").item()
         # 仮想トレードなら注文をキューから取得
-        low = data.daily["low"].iloc[-1]
-        high = data.daily["high"].iloc[-1]
+        low = data.last("low")
+        high = data.last("high")
 
         new_orders = []
         new_orders += self.limit_new_order(low, high, volume)
@@ -979,7 +1523,7 @@ class Simulator:
                 trade_data["new"] = agreed_price
                 trade_data["order_type"] = order.order_type
                 trade_data["assets"]              = self.total_assets(agreed_price)
-                trade_data["min_assets"]          = self.total_assets(data.daily["high"].iloc[-1] if self.position.is_short() else data.daily["low"].iloc[-1])
+                trade_data["min_assets"]          = self.total_assets(data.last("high") if self.position.is_short() else data.last("low"))
                 trade_data["unavailable_assets"]  = trade_data["assets"] - self.assets
                 trade_data["commission"]          = self.position.commission(agreed_price, order.num)
 
@@ -1013,16 +1557,16 @@ class Simulator:
 
     # トレード
     def trade(self, strategy, price, volume, data, index):
-        assert type(data) is SimulatorData, "data is not SimulatorData."
+        assert isinstance(data, SimulatorData), "data is not SimulatorData."
 
-        date = data.daily["date"].iloc[-1]
+        date = data.last("date")
 
         # stats
-        trade_data = self.create_trade_data(date, data.daily["low"].iloc[-1], data.daily["high"].iloc[-1], price)
+        trade_data = self.create_trade_data(date, data.last("low"), data.last("high"), price)
 
         # 判断に必要なデータ数がない
-        if price == 0 or len(data.daily) < self.setting.min_data_length:
-            self.log("less data. skip trade. [%s - %s]. price: %s == 0 or length: %s < %s" % (data.daily["date"].iloc[0], date, price, len(data.daily), self.setting.min_data_length))
+        if price == 0 or data.length() < self.setting.min_data_length:
+            self.log("less data. skip trade. [%s - %s]. price: %s == 0 or length: %s < %s" % (data.daily["date"].iloc[0], date, price, data.length(), self.setting.min_data_length))
             self.stats.append(trade_data)
             return
 
@@ -1042,7 +1586,7 @@ class Simulator:
             trade_data = self.open_trade(volume, data, trade_data)
 
         # 損切の逆指値
-        self.auto_stop_loss(data.daily["close"].iloc[-2], self.position)
+        self.auto_stop_loss(data.last("close", 2), self.position)
 
         # ザラバ
         if self.setting.virtual_trade:
@@ -67,6 +67,9 @@ class CombinationStrategy(CombinationCreator):
 
         return default
 
+    def common_columns(self, leg):
+        return []
+
     def new(self):
         return self.new_conditions
 
@@ -63,8 +63,8 @@ class CombinationStrategy(CombinationCreator):
 
     def break_precondition(self, d):
         conditions = [
-            d.data.daily["high_update"][-2:].max() == 0 and (d.position.gain(self.price(d), d.position.get_num()) <= 0 or sum(d.stats.gain()) <= 0) and d.position.get_num() >= 0,
-            d.data.daily["high_update"][-10:].sum() <= 5
+            d.data.window("high_update", 2).max() == 0 and (d.position.gain(self.price(d), d.position.get_num()) <= 0 or d.stats.sum_gain() <= 0) and d.position.get_num() >= 0,
+            d.data.window("high_update", 10).sum() <= 5
         ]
 
         return any(conditions)
@@ -72,8 +72,8 @@ class CombinationStrategy(CombinationCreator):
     def common(self, setting):
         default = self.default_common()
         default.new = [
-            lambda d: d.index.data["new_score"].daily["score"].iloc[-1] > -400,
-            lambda d: d.data.daily["stop_low"].iloc[-1] == 0,
+            lambda d: d.index.data["new_score"].last("score") > -400,
+            lambda d: d.data.last("stop_low") == 0,
             lambda d: not self.break_precondition(d)
         ]
 
@@ -90,6 +90,10 @@ class CombinationStrategy(CombinationCreator):
 
         return default
 
+    def common_columns(self, leg):
+        columns = {"daily": ["stop_low", "high_update"], "new_score": ["score"]}
+        return columns.get(leg, [])
+
     def new(self):
         return self.new_conditions
 
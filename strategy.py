@@ -4,7 +4,10 @@ import re
 import math
 import numpy
 import inspect
+import weakref
+import operator
 import utils
+import cache
 import simulator
 import itertools
 import time as t
@@ -182,26 +185,54 @@ def load_strategy_by_option(args, is_short):
     combination_setting = create_combination_setting_by_dict(args, setting_dict)
     return load_strategy_creator(args, combination_setting).create(settings)
 
-def load_simulator_data(code, start_date, end_date, args):
+# 読み込みと指標の計算を行うコード (書き換えたらキャッシュを使わない)
+def code_sources():
+    return [inspect.getfile(Loader), utils.__file__, __file__]
+
+# columns: 計算する指標の列 (StrategyCreator.columns, Noneなら全て)
+#   指標を計算した結果だけをキャッシュする (元データはLoaderのキャッシュを通さない, cache.content_cacheを設定したときだけ)
+def load_simulator_data(code, start_date, end_date, args, columns=None):
+    sources = lambda: Loader.sources(code) + code_sources()
+    args_key = (code, start_date, end_date, None if columns is None else sorted(columns))
+    return cache.cached("load_simulator_data", args_key, sources, lambda: load_simulator_data_uncached(code, start_date, end_date, args, columns))
+
+def load_simulator_data_uncached(code, start_date, end_date, args, columns=None):
     rule = "D"
     start = utils.to_format(utils.to_datetime(start_date) - utils.relativeterm(6))
-    data = Loader.load_with_realtime(code, start, end_date)
+    data = Loader.load_with_realtime(code, start, end_date, cached=False)
 
     if data is None:
         print("%s: %s is None" % (start_date, code))
         return None
 
-    simulator_data = add_stats(code, data, rule)
+    simulator_data = add_stats(code, data, rule, columns)
     print("loaded:", utils.timestamp(), code, data["date"].iloc[0], data["date"].iloc[-1])
     return simulator_data
 
-def load_index(args, start_date, end_date):
+# load_simulator_dataを並列に行い、終わった順に (code, SimulatorData, 秒) を返す
+def imap_simulator_data(codes, start_date, end_date, args, columns=None, workers=None, buffer=2):
+    params = map(lambda code: (code, start_date, end_date, args, columns), codes)
+    for (code, _, _, _, _), data, elapsed in utils.parallel_imap(load_simulator_data_by_params, params, workers, buffer):
+        yield code, data, elapsed
+
+def load_simulator_data_by_params(params):
+    code, start_date, end_date, args, columns = params
+    try:
+        return load_simulator_data(code, start_date, end_date, args, columns)
+    except Exception as e:
+        print("load_error: %s" % e)
+        return None
+
+# columns: {"nikkei": [...], "dow": [...]}
+def load_index(args, start_date, end_date, columns=None):
     index = {}
     start = utils.to_format(utils.to_datetime(start_date) - utils.relativeterm(6))
 
     for k in ["nikkei", "dow"]:
-        d = Loader.load_index(k, start, end_date, with_filter=True, strict=False)
-        d = add_stats(k, d, "D")
+        c = None if columns is None else columns.get(k)
+        sources = lambda: Loader.sources(k) + code_sources()
+        args_key = (k, start, end_date, None if c is None else sorted(c))
+        d = cache.cached("load_index", args_key, sources, lambda: add_stats(k, Loader.load_index_uncached(k, start, end_date, with_filter=True, strict=False), "D", c))
         index[k] = d
 
     index["new_score"] = SimulatorData("new_score", Loader.new_score(), "D")
@@ -209,10 +240,10 @@ def load_index(args, start_date, end_date):
 
     return SimulatorIndexData(index)
 
-def add_stats(code, data, rule):
+def add_stats(code, data, rule, columns=None):
     try:
-        data = utils.add_stats(data)
-        data = utils.add_cs_stats(data)
+        data = utils.add_stats(data, columns=columns)
+        data = utils.add_cs_stats(data, columns=columns)
         return SimulatorData(code, data, rule)
     except Exception as e:
         print("load_error: %s" % e)
@@ -301,6 +332,86 @@ def apply_long_short(args, setting):
 
 # ========================================================================
 
+# 条件の判定結果を全期間まとめて保持する (日数 x 条件数)
+#   データだけで決まる条件は一度に計算しておき、各日は行を参照するだけにする
+class ConditionMatrix:
+    def __init__(self, data, index):
+        self.length = len(data.columns["date"])
+        self.vector = simulator.AppliableData(data.to_vector(), index.to_vector(data.columns["date"]), None, None, None, None)
+        self.matrix = numpy.zeros((self.length, 64), dtype=bool)
+        self.size = 0
+        self.keys = {}
+
+    @staticmethod
+    def load(data):
+        if not data.setting.use_condition_matrix:
+            return None
+        return ConditionMatrix.load_by_data(data.data, data.index.source)
+
+    # 結果はSimulatorArrayDataに保持して次のシミュレーションでも使う
+    @staticmethod
+    def load_by_data(data, index):
+        if not isinstance(data, simulator.SimulatorArrayData) or index is None:
+            return None
+
+        # 指標データごとに結果を持つ (matricesはindexを弱参照で持つので、indexが消えれば結果も消える)
+        if index not in data.matrices.keys():
+            data.matrices[index] = ConditionMatrix(data, index)
+        return data.matrices[index]
+
+    # lambdaのコードと引数のデフォルト値が同じなら同じ条件とみなす
+    @staticmethod
+    def condition_key(condition):
+        if isinstance(condition, Condition):
+            return condition.key()
+        if not inspect.isfunction(condition) or condition.__closure__ is not None:
+            return None
+        key = (condition.__code__, condition.__defaults__)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def evaluate(self, condition):
+        try:
+            result = numpy.asarray(condition(self.vector))
+        except:
+            return None # ポジションや統計を使う条件は都度判定する
+
+        if result.dtype != bool or result.shape != (self.length,):
+            return None
+
+        if self.size == self.matrix.shape[1]:
+            self.matrix = numpy.hstack([self.matrix, numpy.zeros(self.matrix.shape, dtype=bool)])
+        self.matrix[:, self.size] = result
+        self.size += 1
+        return self.size - 1
+
+    def column(self, condition):
+        key = self.condition_key(condition)
+        if key is None:
+            return None
+        if key not in self.keys.keys():
+            self.keys[key] = self.evaluate(condition)
+        return self.keys[key]
+
+    def precompute(self, conditions):
+        for condition in conditions:
+            self.column(condition)
+
+    # 計算済みの列と都度判定する条件に分ける
+    def columns(self, conditions):
+        columns = list(map(lambda x: self.column(x), conditions))
+        matrix_columns = numpy.array(list(filter(lambda x: x is not None, columns)), dtype=int)
+        others = list(map(lambda x: x[1], filter(lambda x: x[0] is None, zip(columns, conditions))))
+        return matrix_columns, others
+
+    def values(self, data, columns):
+        row = data.data.length() - 1
+        matrix_columns, others = columns
+        return self.matrix[row, matrix_columns].tolist() + list(map(lambda x: x(data), others))
+
 class StrategyUtil:
     def apply(self, data, conditions, debug=False):
         if len(conditions) == 0:
@@ -322,13 +433,13 @@ class StrategyUtil:
         return all(common)
 
     def price(self, data):
-        return data.data.daily["close"].iloc[-1]
+        return data.data.last("close")
 
     def max_gain(self, data):
         if data.setting.short_trade:
-            max_gain = data.position.gain(data.data.daily["low"].iloc[-data.position.get_term():].min(), data.position.get_num())
+            max_gain = data.position.gain(data.data.window("low", data.position.get_term()).min(), data.position.get_num())
         else:
-            max_gain = data.position.gain(data.data.daily["high"].iloc[-data.position.get_term():].max(), data.position.get_num())
+            max_gain = data.position.gain(data.data.window("high", data.position.get_term()).max(), data.position.get_num())
         return max_gain
 
     # 最大許容損失
@@ -339,12 +450,12 @@ class StrategyUtil:
     def goal(self, data):
         order = data.position.get_num() # 現在の保有数
         if data.setting.short_trade:
-            price = data.data.daily["low"].iloc[-1]
-            line = data.data.daily["support"].iloc[-1]
+            price = data.data.last("low")
+            line = data.data.last("support")
             goal = (price - line)
         else:
-            price = data.data.daily["high"].iloc[-1]
-            line = data.data.daily["resistance"].iloc[-1]
+            price = data.data.last("high")
+            line = data.data.last("resistance")
             goal = (line - price)
 
         goal = 0 if goal < 0 else goal * (order + 1)
@@ -370,32 +481,32 @@ class StrategyUtil:
 
     # 上限
     def upper(self, data, term=1):
-        upper = data.data.daily["resistance"].iloc[-term]
+        upper = data.data.last("resistance", term)
 
         return upper
 
     # 下限
     def lower(self, data, term=1):
-        lower= data.data.daily["support"].iloc[-term]
+        lower= data.data.last("support", term)
 
         return lower
 
     # 不安要素
     def caution(self, data):
-        gain = data.stats.gain()
+        gain = data.stats.last_gain()
         conditions = [
             self.risk(data) == 0, # セーフティーを下回っている
             data.position.get_num() == 0, # 初回の仕掛け
             data.position.gain(self.price(data), data.position.get_num()) < 0, # 損益がマイナス
-            gain[-1] < 0 if len(gain) > 0 else False, # 最後のトレードで損失
+            gain < 0 if gain is not None else False, # 最後のトレードで損失
         ]
         return any(conditions)
 
     # 注目要素
     def attention(self, data):
-        gain = data.stats.gain()
+        gain = data.stats.last_gain()
         conditions = [
-            gain[-1] > 0 if len(gain) > 0 else False, # 最後のトレードで利益
+            gain > 0 if gain is not None else False, # 最後のトレードで利益
             data.position.gain(self.price(data), data.position.get_num()) > 0, # 損益がプラス
         ]
         return any(conditions)
@@ -410,9 +521,9 @@ class StrategyUtil:
 
     def safety(self, data, term):
         if data.setting.short_trade:
-            return data.data.daily["fall_safety"].iloc[-term]
+            return data.data.last("fall_safety", term)
         else:
-            return data.data.daily["rising_safety"].iloc[-term]
+            return data.data.last("rising_safety", term)
 
     def term(self, data):
         return 1 if data.position.get_term()  == 0 else data.position.get_term()
@@ -571,6 +682,10 @@ class StrategyCreator:
     def add_data(self, data):
         return data
 
+    # シミュレーション前に条件の判定結果を計算しておく場合はoverrideする
+    def precompute(self, data, index):
+        pass
+
     def select_dates(self, start_date, end_date, instant):
         return list(utils.daterange(utils.to_datetime(start_date), utils.to_datetime(end_date)))
 
@@ -584,6 +699,10 @@ class StrategyCreator:
     def ranges(self):
         return [[0], [0], [0], [0]]
 
+    # legで参照する列 (Noneなら全ての列を計算する)
+    def columns(self, settings, leg="daily"):
+        return None
+
 class CombinationCreator(StrategyCreator, StrategyUtil):
     def __init__(self, setting=None):
         self.setting = CombinationSetting() if setting is None else setting
@@ -596,6 +715,12 @@ class CombinationCreator(StrategyCreator, StrategyUtil):
         self.x4_conditions = []
         self.x8_conditions = []
         self.x0_5_conditions = []
+        self.conditions_all = []
+
+    def precompute(self, data, index):
+        matrix = ConditionMatrix.load_by_data(data, index)
+        if matrix is not None:
+            matrix.precompute(self.conditions_all)
 
     def ranges(self):
         return [
@@ -657,6 +782,50 @@ class CombinationCreator(StrategyCreator, StrategyUtil):
     def conditions_by_seed(self, seed):
         raise Exception("Need override conditions_by_seed.")
 
+    # StrategyUtilとStrategySimulator(M&Aの判定)で参照する列
+    util_columns = ["high", "low", "close", "atr", "support", "resistance", "rising_safety", "fall_safety", "manda"]
+
+    # 選択された条件 + common + StrategyUtil で参照する列
+    #   settingsがNoneなら選択されうる全ての条件 (設定を入れ替えて検証する場合)
+    #   列が分からない条件(lambda)があるか、commonの列が宣言されていなければ全ての列を計算する
+    def columns(self, settings, leg="daily"):
+        common = self.common_columns(leg)
+        if common is None:
+            return None
+
+        targets = self.candidates() if settings is None else self.selected(settings)
+        targets = list(filter(lambda x: x is not never, targets))
+        if any(map(lambda x: not isinstance(x, Condition), targets)):
+            return None
+
+        columns = set(common)
+        if leg == "daily":
+            columns |= set(self.util_columns)
+
+        for condition in filter(lambda x: x.leg == leg, targets):
+            columns.add(condition.column)
+            if condition.is_column():
+                columns.add(condition.operand)
+
+        return sorted(columns)
+
+    def selected(self, settings):
+        strategy_settings = [StrategySetting()] if len(settings) == 0 else settings
+        conditions = self.conditions(strategy_settings)
+        targets = [conditions.new, conditions.taking, conditions.stop_loss, conditions.closing, conditions.x2, conditions.x4, conditions.x8, conditions.x0_5]
+        return sum(map(lambda x: list(x[0]) + list(x[1]) if len(x) > 0 else [], targets), [])
+
+    def candidates(self):
+        targets = []
+        for seed in self.setting.seed:
+            self.conditions_by_seed(seed)
+            for conditions in [self.conditions_all, self.new(), self.taking(), self.stop_loss(), self.closing(), self.x2(), self.x4(), self.x8(), self.x0_5()]:
+                targets.extend(conditions)
+        return targets
+
+    # commonのlambdaで参照する列 (Noneなら宣言されていないので全ての列を計算する)
+    def common_columns(self, leg):
+        return None
 
     def default_common(self):
         rules = [lambda d: True]
@@ -669,42 +838,42 @@ class CombinationCreator(StrategyCreator, StrategyUtil):
     # 継承したクラスから条件のリストから組み合わせを生成する
     def new(self):
         return [
-            lambda d: False
+            never
         ]
 
     def taking(self):
         return [
-            lambda d: False
+            never
         ]
 
     def stop_loss(self):
         return [
-            lambda d: False
+            never
         ]
 
     def closing(self):
         return [
-            lambda d: False
+            never
         ]
 
     def x2(self):
         return [
-            lambda d: False
+            never
         ]
 
     def x4(self):
         return [
-            lambda d: False
+            never
         ]
 
     def x8(self):
         return [
-            lambda d: False
+            never
         ]
 
     def x0_5(self):
         return [
-            lambda d: False
+            never
         ]
 
 # ensemble用
@@ -727,18 +896,19 @@ class StrategyCreateSetting:
 
 def selectable_data():
     data = {
-        "daily": lambda d: d.data.daily,
-        "nikkei": lambda d: d.index.data["nikkei"].daily,
-        "dow": lambda d: d.index.data["dow"].daily,
-        "new_score": lambda d: d.index.data["new_score"].daily,
-        "industry_score": lambda d: d.index.data["industry_score"].daily
-#        "usdjpy": data.index.data["usdjpy"].daily,
-#        "xbtusd": data.index.data["xbtusd"].daily
+        "daily": lambda d: d.data,
+        "nikkei": lambda d: d.index.data["nikkei"],
+        "dow": lambda d: d.index.data["dow"],
+        "new_score": lambda d: d.index.data["new_score"],
+        "industry_score": lambda d: d.index.data["industry_score"]
+#        "usdjpy": data.index.data["usdjpy"],
+#        "xbtusd": data.index.data["xbtusd"]
     }
 
     return data
 
-def select(data, target="daily"):
+# SimulatorDataを返す (last/windowで値を取り出す)
+def select_data(data, target="daily"):
 
     d = selectable_data()
 
@@ -747,6 +917,85 @@ def select(data, target="daily"):
 
     raise Exception("unselectable: %s" % target)
 
+def select(data, target="daily"):
+    return select_data(data, target).daily
+
+# 常に成立しない条件 (データを参照しない)
+def never(d):
+    return False
+
+# 宣言的な条件
+#   select_data(d, leg) の column を reducer で集計した値と operand を op で比較する
+#   operand が文字列なら同じ leg の列 (operand_n 本前の値) と比較する
+#   last/window を使うだけなので、SimulatorVectorDataを渡すと全期間の判定結果(配列)になる
+class Condition:
+    operators = {
+        ">": operator.gt,
+        "<": operator.lt,
+        ">=": operator.ge,
+        "<=": operator.le,
+        "==": operator.eq,
+        "!=": operator.ne,
+    }
+
+    reducers = ["last", "min", "max", "sum"]
+
+    def __init__(self, leg, column, op, operand, reducer="last", n=1, operand_n=1):
+        assert op in self.operators.keys(), "unknown op: %s" % op
+        assert reducer in self.reducers, "unknown reducer: %s" % reducer
+        self.leg = leg
+        self.column = column
+        self.op = op
+        self.operand = operand
+        self.reducer = reducer
+        self.n = n # last: n本前の値, min/max/sum: 直近n本
+        self.operand_n = operand_n
+
+    def is_column(self):
+        return isinstance(self.operand, str)
+
+    def reduce(self, data):
+        if self.reducer == "last":
+            return data.last(self.column, self.n)
+        window = data.window(self.column, self.n)
+        return getattr(window, self.reducer)()
+
+    def value(self, data):
+        return data.last(self.operand, self.operand_n) if self.is_column() else self.operand
+
+    def __call__(self, d):
+        data = select_data(d, self.leg)
+        return self.operators[self.op](self.reduce(data), self.value(data))
+
+    def key(self):
+        return (self.leg, self.column, self.op, self.operand, self.reducer, self.n, self.operand_n)
+
+    def __eq__(self, other):
+        return isinstance(other, Condition) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    # CombinationChecker用
+    def source(self):
+        selected = "select_data(d, \"%s\")" % self.leg
+        if self.reducer == "last":
+            left = "%s.last(\"%s\")" % (selected, self.column) if self.n == 1 else "%s.last(\"%s\", %s)" % (selected, self.column, self.n)
+        else:
+            left = "%s.window(\"%s\", %s).%s()" % (selected, self.column, self.n, self.reducer)
+
+        if not self.is_column():
+            right = str(self.operand)
+        elif self.operand_n == 1:
+            right = "%s.last(\"%s\")" % (selected, self.operand)
+        else:
+            right = "%s.last(\"%s\", %s)" % (selected, self.operand, self.operand_n)
+
+        return "%s %s %s" % (left, self.op, right)
+
+    def __repr__(self):
+        return self.source()
+
 class CombinationSetting:
     on_close = {
         "new": False,
@@ -776,10 +1025,29 @@ class Combination(StrategyCreator, StrategyUtil):
         self.conditions = conditions
         self.common = common
         self.setting = CombinationSetting() if setting is None else setting
+        self.matrix_columns = weakref.WeakKeyDictionary() # {matrix: {id(conditions): (conditions, 列)}}
+
+    # 条件のリストごとに参照する列を覚えておく (conditionsも持っておくので同じidが別のリストに使われることはない)
+    def columns(self, matrix, conditions):
+        columns = self.matrix_columns.setdefault(matrix, {})
+        if id(conditions) not in columns.keys():
+            columns[id(conditions)] = (conditions, matrix.columns(conditions))
+        return columns[id(conditions)][1]
+
+    # 判定結果が計算済みなら行を参照するだけ
+    def apply(self, data, conditions, debug=False):
+        matrix = ConditionMatrix.load(data)
+        if matrix is None or len(conditions) == 0 or debug:
+            return super().apply(data, conditions, debug)
+
+        a = matrix.values(data, self.columns(matrix, conditions[0]))
+        b = matrix.values(data, self.columns(matrix, conditions[1]))
+
+        return all(a) and (any(b) or len(b) == 0)
 
     def drawdown_allowable(self, data):
         allowable_dd = data.setting.stop_loss_rate
-        drawdown = data.stats.drawdown()[-20:]
+        drawdown = data.stats.recent_drawdown(20)
         drawdown_diff = list(filter(lambda x: x > allowable_dd, drawdown)) if len(drawdown) > 1 else []
         drawdown_sum = list(filter(lambda x: x > 0, numpy.diff(drawdown))) if len(drawdown) > 1 else []
         drawdown_conditions = [
@@ -859,7 +1127,7 @@ class Combination(StrategyCreator, StrategyUtil):
         order = data.position.get_num()
         gain = data.position.gain(self.price(data), order)
         take_gain = self.taking_gain(data, self.setting.max_position_size)
-        atr_take_gain = data.data.daily["atr"].iloc[-1] * data.setting.min_unit * order
+        atr_take_gain = data.data.last("atr") * data.setting.min_unit * order
         stop_loss = self.stop_loss(data, self.setting.max_position_size)
         max_gain = self.max_gain(data)
         conditions = []
@@ -934,6 +1202,9 @@ class Combination(StrategyCreator, StrategyUtil):
 class CombinationChecker:
 
     def get_replaced_source(self, condition):
+        if isinstance(condition, Condition):
+            return condition.source()
+
         source = inspect.getsource(condition)
         argspec = inspect.getfullargspec(condition)
 
@@ -1,6 +1,8 @@
 import sys
 import numpy
 import time
+import copy
+import multiprocessing
 from datetime import datetime
 
 sys.path.append("lib")
@@ -8,15 +10,31 @@ import checker
 import cache
 import utils
 import strategy
-from simulator import Simulator
+from simulator import Simulator, SimulatorData, SimulatorSharedData
 
+# 並列実行中のシミュレーターとデータ (forkしたワーカーはコピーせずにそのまま参照する)
+parallel_targets = {}
+
+# 共有メモリ上のデータを参照するワーカーの初期化
+def parallel_attach(simulator, args, shared_data):
+    stocks, index = shared_data.attach()
+    parallel_targets["simulator"] = simulator
+    parallel_targets["data"] = {"args": args, "data": stocks, "index": index}
+    parallel_targets["shared_data"] = shared_data
+
+def parallel_simulates(params):
+    strategy_setting, start_date, end_date = params
+    return parallel_targets["simulator"].simulates(strategy_setting, parallel_targets["data"], start_date, end_date)
 
 class StrategySimulator:
+    window = 300 # get_data_by_dateで指標を計算する足の数
+
     def __init__(self, simulator_setting, combination_setting, strategy_settings, verbose=False):
         self.simulator_setting = simulator_setting
         self.combination_setting = combination_setting
         self.strategy_settings = strategy_settings
         self.verbose = verbose
+        self.states = {} # 銘柄ごとの前日までの指標 (data_by_date)
 
     def strategy_creator(self, args):
         return strategy.load_strategy_creator(args, self.combination_setting)
@@ -40,20 +58,97 @@ class StrategySimulator:
             targets = [args.code]
         return targets
 
+    # 戦略が参照する列だけを計算して銘柄と指標を読み込む (simulatesに渡すデータ)
+    #   simulatesでは最後の設定を入れ替えるので、選択されうる全ての条件で参照する列を計算する
+    def load(self, args, start_date, end_date, workers=1):
+        strategy_creator = self.strategy_creator(args)
+        codes = self.select_codes(args, start_date, end_date)
+
+        stocks = {}
+        for code, data, _ in strategy.imap_simulator_data(codes, start_date, end_date, args, strategy_creator.columns(None), workers):
+            if data is not None:
+                stocks[code] = data
+
+        columns = dict(map(lambda x: (x, strategy_creator.columns(None, x)), ["nikkei", "dow"]))
+        index = strategy.load_index(args, start_date, end_date, columns)
+        return {"args": args, "data": stocks, "index": index}
+
     def log(self, message):
         if self.verbose:
              print(message)
 
-    def get_data_by_date(data, date):
-        # filter -> ohlc をすべてoにする-> add_stats
+    # filter -> ohlc をすべてoにする-> add_stats
+    #   stateに前日までの指標(utils.IncrementalStats)を渡すと、前回から増えた足だけを確定させて当日の足を仮に追加する
+    @staticmethod
+    def get_data_by_date(data, date, state=None):
         d = data.daily
-        d = d[d["date"] <= date].iloc[-300:].copy()
+        d = d[d["date"] <= date].iloc[-StrategySimulator.window:]
+        state = utils.IncrementalStats(window=StrategySimulator.window) if state is None else state
+
+        state.rollback()
+        committed = d.iloc[:-1]
+        if state.last("date") is not None:
+            committed = committed[committed["date"] > state.last("date")]
+        state.extend(committed)
+
+        bar = d.iloc[-1].to_dict()
         for column in ["high", "low", "close"]:
-            tmp = d[column].values.tolist()
-            tmp[-1] = d["open"].iloc[-1]
-            d[column] = tmp
-        d = strategy.add_stats(data.code, d, data.rule)
-        return d
+            bar[column] = bar["open"]
+        state.update(bar, provisional=True)
+
+        return SimulatorData(data.code, state.to_dataframe(), data.rule)
+
+    # 銘柄ごとに指標の状態を持ち回ってget_data_by_dateする (日付は昇順に呼ぶ)
+    def data_by_date(self, data, date):
+        state = self.states.get(data.code)
+        if state is None or (state.last("date") is not None and state.last("date") >= date):
+            state = utils.IncrementalStats(window=self.window)
+            self.states[data.code] = state
+        return self.get_data_by_date(data, date, state)
+
+    def precompute(self, strategy_creator, stocks, index, codes):
+        if not self.simulator_setting.use_array_data or not self.simulator_setting.use_condition_matrix:
+            return
+        for code in codes:
+            strategy_creator.precompute(stocks[code].to_array(), index.to_array())
+
+    # 複数の設定を並列に検証する (結果はstrategy_settingsの順)
+    #   shared=Trueならデータを共有メモリに置いてワーカーから参照する (forkできない環境ではTrue)
+    def parallel_simulates(self, strategy_settings, data, start_date, end_date, workers=None, chunksize=1, shared=None):
+        workers = multiprocessing.cpu_count() if workers is None else workers
+        params = list(map(lambda x: (x, start_date, end_date), strategy_settings))
+
+        if workers <= 1 or len(params) <= 1:
+            return list(map(lambda x: self.simulates(x, data, start_date, end_date), strategy_settings))
+
+        shared = not "fork" in multiprocessing.get_all_start_methods() if shared is None else shared
+        if shared:
+            return self.shared_simulates(params, data, min(workers, len(params)), chunksize)
+
+        # ワーカーで共有できるようにfork前に配列化と条件の計算を済ませておく
+        args = data["args"]
+        self.precompute(self.strategy_creator(args), data["data"], data["index"], self.get_targets(args, [], start_date))
+
+        parallel_targets["simulator"] = self
+        parallel_targets["data"] = data
+        try:
+            with multiprocessing.get_context("fork").Pool(min(workers, len(params))) as pool:
+                return pool.map(parallel_simulates, params, chunksize=chunksize)
+        finally:
+            parallel_targets.clear()
+
+    def shared_simulates(self, params, data, workers, chunksize):
+        # ワーカーに送るのは設定と共有メモリの名前だけ
+        simulator_setting = copy.copy(self.simulator_setting)
+        simulator_setting.strategy = None
+        simulator = StrategySimulator(simulator_setting, self.combination_setting, self.strategy_settings, self.verbose)
+
+        shared_data = SimulatorSharedData.publish(data["data"], data["index"])
+        try:
+            with multiprocessing.Pool(workers, initializer=parallel_attach, initargs=(simulator, data["args"], shared_data)) as pool:
+                return pool.map(parallel_simulates, params, chunksize=chunksize)
+        finally:
+            shared_data.unlink()
 
     def simulates(self, strategy_setting, data, start_date, end_date):
         self.log("simulating %s %s" % (start_date, end_date))
@@ -78,6 +173,9 @@ class StrategySimulator:
                 continue
             simulators[code] = Simulator(simulator_setting)
 
+        # 条件の判定結果を全期間まとめて計算
+        self.precompute(strategy_creator, stocks, index, simulators.keys())
+
         # 日付のリストを取得
         dates = []
         dates_dict = {}
@@ -134,11 +232,10 @@ class StrategySimulator:
     def agg(self, stats, target, proc=None):
         results = {}
         for s in stats.values():
-            for history in s.trade_history:
-                date = history["date"]
+            for date, value in zip(s.values("date"), s.values(target)):
                 if date is None:
                     continue
-                d = history[target] if proc is None else proc(history[target])
+                d = value if proc is None else proc(value)
                 if date in results.keys():
                     results[date] += d
                 else:
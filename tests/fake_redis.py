@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# redis.Redisの代わりに使うメモリ上のクライアント (redis-serverなしでcache.Redisを確認する)
+class FakeRedisClient:
+    def __init__(self):
+        self.data = {}
+        self.round_trips = 0
+
+    def get(self, name):
+        self.round_trips += 1
+        return self.data.get(name)
+
+    def getrange(self, name, start, end):
+        self.round_trips += 1
+        return self.data.get(name, b"")[start:end + 1]
+
+    def set(self, name, value):
+        self.round_trips += 1
+        self.data[name] = bytes(value)
+        return True
+
+    def mget(self, names):
+        self.round_trips += 1
+        return list(map(lambda x: self.data.get(x), names))
+
+    def exists(self, *names):
+        self.round_trips += 1
+        return len(list(filter(lambda x: x in self.data.keys(), names)))
+
+    def delete(self, *names):
+        self.round_trips += 1
+        deleted = list(filter(lambda x: x in self.data.keys(), names))
+        for name in deleted:
+            del self.data[name]
+        return len(deleted)
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+# コマンドを溜めておき、executeでまとめて1回の往復として実行する
+class FakeRedisPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, name, value):
+        self.commands.append(("set", (name, value)))
+        return self
+
+    def getrange(self, name, start, end):
+        self.commands.append(("getrange", (name, start, end)))
+        return self
+
+    def delete(self, *names):
+        self.commands.append(("delete", names))
+        return self
+
+    def execute(self):
+        round_trips = self.client.round_trips
+        results = list(map(lambda x: getattr(self.client, x[0])(*x[1]), self.commands))
+        self.client.round_trips = round_trips + 1
+        self.commands = []
+        return results
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import numpy
+import pandas
+import strategy
+from simulator import SimulatorData, SimulatorIndexData
+
+def create_frame(n, seed, base=1000):
+    r = numpy.random.RandomState(seed)
+    close = numpy.maximum((base + numpy.cumsum(r.randn(n) * base * 0.01)).astype(int), 50)
+    open_ = (close + r.randn(n) * base * 0.005).astype(int)
+    return pandas.DataFrame({
+        "date": pandas.bdate_range("2015-01-05", periods=n),
+        "open": open_,
+        "high": numpy.maximum(open_, close) + r.randint(0, base // 50, n),
+        "low": numpy.minimum(open_, close) - r.randint(0, base // 50, n),
+        "close": close,
+        "volume": r.randint(100, 10000, n),
+    })
+
+def create_data(code, n, seed, base=1000, columns=None):
+    return strategy.add_stats(code, create_frame(n, seed, base), "D", columns)
+
+# 指標の計算期間のNaNに加えて途中にもNaNを含むデータ
+#   columns: {"nikkei": [...], "dow": [...]}
+def create_index(dates, columns={}):
+    n = len(dates)
+    r = numpy.random.RandomState(7)
+    score = r.randint(-3000, 500, n).astype(float)
+    score[:15] = numpy.nan
+    score[30:40] = numpy.nan
+    data = {
+        "nikkei": create_data("nikkei", n, 100, 20000, columns.get("nikkei")),
+        "dow": create_data("dow", n, 101, 20000, columns.get("dow")),
+        "new_score": SimulatorData("new_score", pandas.DataFrame({"date": dates, "score": score}), "D"),
+        "industry_score": SimulatorData("industry_score", pandas.DataFrame({
+            "date": dates,
+            "featured_falling": r.randint(0, 30, n),
+            "featured_rising": r.randint(0, 30, n),
+            "rising": r.randint(0, 40, n),
+            "falling": r.randint(0, 40, n),
+        }), "D"),
+    }
+    return SimulatorIndexData(data)
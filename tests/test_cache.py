@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import pickle
+import numpy
+import pytest
+import cache
+from fake_redis import FakeRedisClient
+
+def chunks(client, name):
+    return sorted(filter(lambda x: x.startswith("%s:chunk:" % name), client.data.keys()))
+
+# 上書きすると前の世代の分割したキーは消える
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_redis_overwrite_chunks(compression):
+    client = FakeRedisClient()
+    redis = cache.Redis(client=client, compression=compression, chunk_size=1000)
+
+    first = numpy.arange(1000)
+    assert redis.mset({"x0": first, "x1": 1})
+    previous = chunks(client, "x0")
+    assert len(previous) > 1
+
+    second = numpy.arange(1000) * 2
+    assert redis.mset({"x0": second})
+    current = chunks(client, "x0")
+    assert len(current) > 1 and set(previous).isdisjoint(current)
+
+    (found, data), (found1, data1) = redis.mget(["x0", "x1"])
+    assert found and (data == second).all()
+    assert found1 and data1 == 1
+
+    redis.mset({"x0": "small"})
+    assert chunks(client, "x0") == [] and redis.get("x0") == "small"
+
+    redis.create("x0", first)
+    redis.remove("x0")
+    assert chunks(client, "x0") == [] and not redis.exists("x0")
+
+# ヘッダが指す世代の分割が消えていたら見つからないものとして扱う
+def test_redis_missing_generation():
+    client = FakeRedisClient()
+    redis = cache.Redis(client=client, chunk_size=1000)
+    redis.create("x0", numpy.arange(1000))
+    header = client.data["x0"]
+    redis.create("x0", numpy.arange(1000) * 2)
+    client.data["x0"] = header
+    assert redis.mget(["x0"]) == [(False, None)]
+
+# pickleをそのまま保存した値も読める
+def test_redis_raw_pickle():
+    client = FakeRedisClient()
+    client.data["x0"] = pickle.dumps([1, 2])
+    redis = cache.Redis(client=client)
+    assert redis.get("x0") == [1, 2]
+    redis.remove("x0")
+    assert client.data == {}
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import conditions
+from strategy import Condition, ConditionMatrix
+from simulator import AppliableData
+from sample import create_data, create_index
+
+def nan_conditions():
+    return [
+        Condition("new_score", "score", "<=", 5, reducer="sum", n=3),
+        Condition("new_score", "score", "==", 0, reducer="sum", n=5),
+        Condition("new_score", "score", ">", -1000, reducer="max", n=3),
+        Condition("new_score", "score", "<", -1000, reducer="min", n=3),
+        Condition("daily", "stages_average", ">", 0, reducer="min", n=3),
+        Condition("daily", "high_update", "<=", 1, reducer="sum", n=10),
+    ]
+
+def evaluate(data, index, date, condition):
+    d = AppliableData(data.split_by_cursor(data.cursor(), date), index.split_by_cursors(index.cursors(), date), None, None, None, None)
+    try:
+        return bool(condition(d))
+    except:
+        return None
+
+def test_matrix_matches_per_day_with_nan():
+    data = create_data("1000", 60, 0)
+    index = create_index(data.daily["date"])
+    targets = conditions.all_with_index(["daily", "nikkei", "dow"]) + conditions.new_score_conditions() + nan_conditions()
+
+    array, array_index = data.to_array(), index.to_array()
+    matrix = ConditionMatrix(array, array_index)
+    # dowは前日までなので初日は空になる
+    for row, date in enumerate(data.daily["date"].iloc[1:], 1):
+        for condition in targets:
+            column = matrix.column(condition)
+            expected = evaluate(array, array_index, date, condition)
+            if column is None or expected is None:
+                continue
+            assert matrix.matrix[row, column] == expected, (date, condition)
+
+# 集計はpandas.Seriesと同じくNaNを除く
+def test_window_matches_dataframe_with_nan():
+    data = create_data("1000", 60, 0)
+    index = create_index(data.daily["date"])
+    targets = list(filter(lambda x: x.reducer != "last", conditions.all_with_index(["daily"]) + conditions.new_score_conditions())) + nan_conditions()
+
+    for date in data.daily["date"].iloc[1:]:
+        for condition in targets:
+            assert evaluate(data, index, date, condition) == evaluate(data.to_array(), index.to_array(), date, condition), (date, condition)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import pytest
+import strategy
+from types import SimpleNamespace
+from simulator import SimulatorSetting, SimulatorData
+from strategy_simulator import StrategySimulator
+from sample import create_frame, create_data, create_index
+
+def create_args(code, production, strategy_type):
+    args = SimpleNamespace(code=code, instant=False, production=production, short=False, long_short=False, ensemble=False, open_close=False, futures=False, new_high=False, simple=False)
+    setattr(args, strategy_type, True)
+    return args
+
+def simulates(args, stocks, index):
+    simulator_setting = SimulatorSetting()
+    simulator_setting.assets = 3000000
+    combination_setting = strategy.CombinationSetting()
+    combination_setting.seed = [1]
+    combination_setting.position_sizing = True
+    simulator = StrategySimulator(simulator_setting, combination_setting, [strategy.StrategySetting()])
+    setting = strategy.StrategySetting().by_array([8, 7, 4, 5, 5, 9, 11, 3])
+    dates = stocks[args.code].daily["date"]
+    return simulator.simulates(setting, {"args": args, "data": stocks, "index": index}, str(dates.iloc[30].date()), str(dates.iloc[-1].date()))
+
+# 戦略が参照する列だけを計算したデータでも全ての列と同じ結果になる
+@pytest.mark.parametrize("production", [False, True])
+@pytest.mark.parametrize("strategy_type", ["combination", "futures", "new_high"])
+def test_simulates_with_planned_columns(production, strategy_type):
+    args = create_args("1000", production, strategy_type)
+    creator = strategy.load_strategy_creator(args)
+    columns = creator.columns(None)
+    index_columns = {"nikkei": creator.columns(None, "nikkei"), "dow": creator.columns(None, "dow")}
+    assert columns is not None and "manda" in columns
+
+    full = create_data("1000", 200, 0)
+    planned = create_data("1000", 200, 0, columns=columns)
+    assert len(planned.daily.columns) < len(full.daily.columns)
+
+    dates = full.daily["date"]
+    expected = simulates(args, {"1000": full}, create_index(dates))
+    assert simulates(args, {"1000": planned}, create_index(dates, index_columns)) == expected
+
+# 指標の状態を持ち回っても当日の足は毎回計算し直したものと同じになり、保持する足はwindowまで
+def test_data_by_date_with_state(monkeypatch):
+    monkeypatch.setattr(StrategySimulator, "window", 100)
+    data = SimulatorData("1000", create_frame(150, 3), "D")
+    simulator = StrategySimulator(None, None, [])
+    for date in data.daily["date"].iloc[120:130]:
+        expected = StrategySimulator.get_data_by_date(data, date).daily
+        actual = simulator.data_by_date(data, date).daily
+        assert len(actual) == len(expected) == 100
+        for column in ["close", "daily_average", "rci", "stages", "rising_safety", "yang", "high_update"]:
+            assert actual[column].iloc[-1] == pytest.approx(expected[column].iloc[-1], nan_ok=True)
+    assert len(simulator.states["1000"].rows) <= 101
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import os
+import utils
+from datetime import datetime
+
+# 年末年始(12/31, 1/1~1/3)は休場
+def test_is_weekday_year_end():
+    assert utils.is_weekday(datetime(2019, 12, 30))
+    assert not utils.is_weekday(datetime(2019, 12, 31))
+    assert not utils.is_weekday(datetime(2020, 1, 1))
+    assert not utils.is_weekday(datetime(2020, 1, 2))
+    assert not utils.is_weekday(datetime(2020, 1, 3))
+    assert utils.is_weekday(datetime(2020, 1, 6))
+
+def test_select_weekday_year_end():
+    assert utils.select_weekday(datetime(2020, 1, 3)) == datetime(2019, 12, 30)
+    assert utils.trading_calendar().next(datetime(2019, 12, 30)) == datetime(2020, 1, 6)
+
+# 保存した営業日はjpholidayのバージョンごとに分ける
+def test_trading_calendar_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.TradingCalendar, "cache_dir", str(tmp_path))
+    calendar = utils.TradingCalendar(2019, 2020)
+    assert os.listdir(str(tmp_path)) == [os.path.basename(calendar.path(2019, 2020))]
+    assert utils.TradingCalendar.holiday_version() in calendar.path(2019, 2020)
+
+    monkeypatch.setattr(utils.TradingCalendar, "holiday_version", staticmethod(lambda: "next"))
+    assert utils.TradingCalendar(2019, 2020).flags.tolist() == calendar.flags.tolist()
+    assert len(os.listdir(str(tmp_path))) == 2
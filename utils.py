@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import numpy
 import math
 import pandas
@@ -6,6 +7,10 @@ import json
 import jpholiday
 import statsmodels.api as sm
 import collections
+import copy
+import importlib.metadata
+import multiprocessing
+import threading
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from functools import wraps
@@ -17,118 +22,157 @@ import time
 def nan_to_num(data, default=0):
     return data if default is None else numpy.nan_to_num(data)
 
-def add_average_stats(data):
-    close = numpy.array(data["close"].values, dtype="f8")
-    data["daily_average"]     = ta.SMA(close, timeperiod=5)
-    data["weekly_average"]    = ta.SMA(close, timeperiod=25)
-    data["volume_average"]    = ta.SMA(data["volume"].astype(float).values, timeperiod=5)
-    data["ma_divergence"]     = (data["close"] - data["weekly_average"]) / data["weekly_average"]
+def f8(data):
+    return numpy.array(data.values, dtype="f8")
+
+# 複数の列を一度に計算する指標の1列
+#   同じ計算(key)の結果はapply_statsの中で使いまわす
+class SharedStats:
+    def __init__(self, key, callback, index):
+        self.key = key
+        self.callback = callback
+        self.index = index
+
+    def __call__(self, data, results=None):
+        results = {} if results is None else results
+        if self.key not in results.keys():
+            results[self.key] = self.callback(data)
+        return results[self.key][self.index]
+
+def macd_stats(data):
+    return ta.MACD(f8(data["close"]), fastperiod=12, slowperiod=26, signalperiod=9)
+
+def bbands_stats(data, dev):
+    return list(map(nan_to_num, ta.BBANDS(f8(data["close"]), timeperiod=25, nbdevup=dev, nbdevdn=dev, matype=0)))
+
+# 指標の列ごとに (列名, 前提の列, 計算) を並べる
+#   columns を指定すると、その列と前提の列だけを計算する
+average_stats = [
+    ("daily_average",   ["close"], lambda d: ta.SMA(f8(d["close"]), timeperiod=5)),
+    ("weekly_average",  ["close"], lambda d: ta.SMA(f8(d["close"]), timeperiod=25)),
+    ("volume_average",  ["volume"], lambda d: ta.SMA(d["volume"].astype(float).values, timeperiod=5)),
+    ("ma_divergence",   ["close", "weekly_average"], lambda d: (d["close"] - d["weekly_average"]) / d["weekly_average"]),
+]
+
+tec_stats = [
+    ("rci",                 ["close"], lambda d: rolling_apply(d["close"], 9, rolling_rci)),
+    ("rci_long",            ["close"], lambda d: rolling_apply(d["close"], 27, rolling_rci)),
+    ("macd",                ["close"], SharedStats("macd", macd_stats, 0)),
+    ("macdsignal",          ["close"], SharedStats("macd", macd_stats, 1)),
+    ("macdhist",            ["close"], SharedStats("macd", macd_stats, 2)),
+    ("macdhist_convert",    ["macdhist"], lambda d: rolling_apply(d["macdhist"], 100, rolling_trend_convert)),
+    ("atr",                 ["high", "low", "close"], lambda d: ta.ATR(d["high"].astype(float).values, d["low"].astype(float).values, d["close"].astype(float).values, timeperiod=14)), # average true range
+]
+
+band_stats = [
+    ("env12",               ["close"], SharedStats("bbands2", lambda d: bbands_stats(d, 2), 0)),
+    ("env11",               ["close"], SharedStats("bbands1", lambda d: bbands_stats(d, 1), 0)),
+    ("env09",               ["close"], SharedStats("bbands1", lambda d: bbands_stats(d, 1), 2)),
+    ("env08",               ["close"], SharedStats("bbands2", lambda d: bbands_stats(d, 2), 2)),
+    ("env_entity",          ["env12", "env08"], lambda d: d["env12"] - d["env08"]),
+    ("env_entity_average",  ["env_entity"], lambda d: ta.SMA(f8(d["env_entity"]), timeperiod=5)),
+]
+
+safety_stats = [
+    ("low_noize",           ["low"], lambda d: rolling_apply(d["low"], 2, rolling_low_noize)),
+    ("rising_safety",       ["low", "low_noize"], lambda d: (d["low"] + rolling_apply(d["low_noize"], 10, rolling_rising_safety)).rolling(3).max()), # 過去のsafetyより低い場合は高い方に合わせる
+    ("high_noize",          ["high"], lambda d: rolling_apply(d["high"], 2, rolling_high_noize)),
+    ("fall_safety",         ["high", "high_noize"], lambda d: (d["high"] + rolling_apply(d["high_noize"], 10, rolling_fall_safety)).rolling(3).min()), # 過去のsafetyより高い場合は低い方に合わせる
+]
+
+stages_stats = [
+    ("resistance",          ["high"], lambda d: d["high"].rolling(15).max()),
+    ("support",             ["low"], lambda d: d["low"].rolling(15).min()),
+    ("stages",              ["high", "low", "daily_average", "resistance", "support"], lambda d: stages(d)),
+    ("stages_average",      ["stages"], lambda d: ta.SMA(d["stages"].astype(float).values, timeperiod=10)),
+    ("macd_stages",         ["macd"], lambda d: (d["macd"] > 0) * 1),
+    ("macdhist_stages",     ["macdhist"], lambda d: (d["macdhist"] > 0) * 1),
+]
+
+# クロス系
+cross_columns = {
+    "average_cross":        ("daily_average", "weekly_average"),
+    "macd_cross":           ("macd", "macdsignal"),
+    "rci_cross":            ("rci", "rci_long"),
+    "env12_cross":          ("high", "env12"),
+    "env11_cross":          ("high", "env11"),
+    "env09_cross":          ("low", "env09"),
+    "env08_cross":          ("low", "env08"),
+    "rising_safety_cross":  ("low", "rising_safety"),
+    "fall_safety_cross":    ("high", "fall_safety"),
+}
+
+cross_stats = list(map(lambda x: (x[0], list(x[1]), lambda d, c=x[1]: cross(d[c[0]], d[c[1]])), cross_columns.items()))
+
+# 気配を出力する
+gradient_columns = {
+    "rci_long_gradient":        "rci_long",
+    "rci_gradient":             "rci",
+    "volume_gradient":          "volume_average",
+    "weekly_gradient":          "weekly_average",
+    "daily_gradient":           "daily_average",
+    "stages_average_gradient":  "stages_average",
+    "stages_gradient":          "stages",
+    "fall_safety_gradient":     "fall_safety",
+    "rising_safety_gradient":   "rising_safety",
+    "macd_gradient":            "macd",
+    "macdhist_gradient":        "macdhist",
+}
+
+trend_columns = {
+    "daily_average_trend":      ("daily_gradient", 5),
+    "weekly_average_trend":     ("weekly_gradient", 5),
+    "volume_average_trend":     ("volume_gradient", 5),
+    "macd_trend":               ("macd_gradient", 5),
+    "macdhist_trend":           ("macdhist_gradient", 1),
+    "rci_trend":                ("rci_gradient", 5),
+    "rci_long_trend":           ("rci_long_gradient", 5),
+    "stages_trend":             ("stages_gradient", 5),
+    "stages_average_trend":     ("stages_average_gradient", 5),
+    "rising_safety_trend":      ("rising_safety_gradient", 5),
+    "fall_safety_trend":        ("fall_safety_gradient", 5),
+}
+
+trend_stats = list(map(lambda x: (x[0], [x[1]], lambda d, c=x[1]: diff(d[c])), gradient_columns.items())) \
+    + list(map(lambda x: (x[0], [x[1][0]], lambda d, c=x[1]: rolling_apply(d[c[0]], c[1], rolling_trend)), trend_columns.items()))
+
+manda_stats = [
+    ("pct_change",          ["close"], lambda d: d["close"].pct_change()),
+    ("stock_split",         ["pct_change"], lambda d: (d["pct_change"] < -0.45) * 1),
+    ("reverse_stock_split", ["pct_change"], lambda d: (d["pct_change"] > 2.0) * 1),
+    ("manda",               ["stock_split", "reverse_stock_split"], lambda d: ((d["stock_split"] == 1) | (d["reverse_stock_split"] == 1)) * 1),
+]
+
+def apply_stats(data, stats, columns=None):
+    results = {} # SharedStatsの計算結果
+    for name, _, callback in stats:
+        if columns is None or name in columns:
+            data[name] = callback(data, results) if isinstance(callback, SharedStats) else callback(data)
     return data
 
-def add_tec_stats(data):
-    data["rci"]                 = data["close"].rolling(9).apply(rci, raw=True)
-    data["rci_long"]            = data["close"].rolling(27).apply(rci, raw=True)
+def add_average_stats(data, columns=None):
+    return apply_stats(data, average_stats, columns)
 
-    close = numpy.array(data["close"].values, dtype="f8")
-    macd, macdsignal, macdhist = ta.MACD(close, fastperiod=12, slowperiod=26, signalperiod=9)
-    data["macd"]           = macd
-    data["macdsignal"]     = macdsignal
-    data["macdhist"]       = macdhist
-    data["macdhist_convert"] = data["macdhist"].rolling(100).apply(trend_convert, raw=True)
+def add_tec_stats(data, columns=None):
+    return apply_stats(data, tec_stats, columns)
 
-    # average true range
-    data["atr"] = ta.ATR(data["high"].astype(float).values, data["low"].astype(float).values, data["close"].astype(float).values, timeperiod=14)
-    return data
-
-def add_band_stats(data):
-    close = numpy.array(data["close"].values, dtype="f8")
-    upper, _, lower = ta.BBANDS(close, timeperiod=25, nbdevup=1, nbdevdn=1, matype=0)
-    upper2, _, lower2 = ta.BBANDS(close, timeperiod=25, matype=0)
-
-    data["env12"]          = nan_to_num(upper2)
-    data["env11"]          = nan_to_num(upper)
-    data["env09"]          = nan_to_num(lower)
-    data["env08"]          = nan_to_num(lower2)
+def add_band_stats(data, columns=None):
+    return apply_stats(data, band_stats, columns)
 
-    data["env_entity"]     =  each(lambda i, x: x["env12"] - x["env08"], data)
-    data["env_entity_average"] = ta.SMA(numpy.array(data["env_entity"].values, dtype="f8"), timeperiod=5)
-    return data
+def add_safety_stats(data, columns=None):
+    return apply_stats(data, safety_stats, columns)
 
-def add_safety_stats(data):
-    data["low_noize"]         = data["low"].rolling(2).apply(lambda x: x[-2] - x[-1] if x[-2] - x[-1] < 0 else 0, raw=True)
-    data["rising_safety"]     = data["low_noize"].rolling(10).apply(rising_safety, raw=True)
-    data["rising_safety"]     = data["low"] + data["rising_safety"]
-    data["rising_safety"]     = data["rising_safety"].rolling(3).max() # 過去のsafetyより低い場合は高い方に合わせる
+def add_stages_stats(data, columns=None):
+    return apply_stats(data, stages_stats, columns)
 
-    data["high_noize"]        = data["high"].rolling(2).apply(lambda x: x[-2] - x[-1] if x[-2] - x[-1] > 0 else 0, raw=True)
-    data["fall_safety"]       = data["high_noize"].rolling(10).apply(fall_safety, raw=True)
-    data["fall_safety"]       = data["high"] + data["fall_safety"]
-    data["fall_safety"]       = data["fall_safety"].rolling(3).min() # 過去のsafetyより高い場合は低い方に合わせる
+def add_cross_stats(data, columns=None):
+    return apply_stats(data, cross_stats, columns)
 
-    return data
+def add_trend_stats(data, columns=None):
+    return apply_stats(data, trend_stats, columns)
 
-def add_stages_stats(data):
-    data["resistance"] = data["high"].rolling(15).max()
-    data["support"] = data["low"].rolling(15).min()
-
-    data["stages"]                      = stages(data)
-    stages_average                      = ta.SMA(data["stages"].astype(float).values, timeperiod=10)
-    data["stages_average"]              = stages_average
-    data["macd_stages"]                 = (data["macd"] > 0) * 1
-    data["macdhist_stages"]             = (data["macdhist"] > 0) * 1
-    return data
-
-def add_cross_stats(data):
-    # クロス系
-    data["average_cross"] = cross(data["daily_average"], data["weekly_average"])
-    data["macd_cross"] = cross(data["macd"], data["macdsignal"])
-    data["rci_cross"] = cross(data["rci"], data["rci_long"])
-
-    data["env12_cross"] = cross(data["high"], data["env12"])
-    data["env11_cross"] = cross(data["high"], data["env11"])
-    data["env09_cross"] = cross(data["low"], data["env09"])
-    data["env08_cross"] = cross(data["low"], data["env08"])
-
-    data["rising_safety_cross"] = cross(data["low"], data["rising_safety"])
-    data["fall_safety_cross"] = cross(data["high"], data["fall_safety"])
-
-    return data
-
-def add_trend_stats(data):
-    # 気配を出力する
-    data["rci_long_gradient"]           = diff(data["rci_long"])
-    data["rci_gradient"]                = diff(data["rci"])
-    data["volume_gradient"]             = diff(data["volume_average"])
-    data["weekly_gradient"]             = diff(data["weekly_average"])
-    data["daily_gradient"]              = diff(data["daily_average"])
-    data["stages_average_gradient"]     = diff(data["stages_average"])
-    data["stages_gradient"]             = diff(data["stages"])
-    data["fall_safety_gradient"]        = diff(data["fall_safety"])
-    data["rising_safety_gradient"]      = diff(data["rising_safety"])
-    data["macd_gradient"]               = diff(data["macd"])
-    data["macdhist_gradient"]           = diff(data["macdhist"])
-
-    data["daily_average_trend"] = data["daily_gradient"].rolling(5).apply(trend, raw=True)
-    data["weekly_average_trend"] = data["weekly_gradient"].rolling(5).apply(trend, raw=True)
-    data["volume_average_trend"] = data["volume_gradient"].rolling(5).apply(trend, raw=True)
-    data["macd_trend"] = data["macd_gradient"].rolling(5).apply(trend, raw=True)
-    data["macdhist_trend"] = data["macdhist_gradient"].rolling(1).apply(trend, raw=True)
-    data["rci_trend"]       = data["rci_gradient"].rolling(5).apply(trend, raw=True)
-    data["rci_long_trend"]  = data["rci_long_gradient"].rolling(5).apply(trend, raw=True)
-    data["stages_trend"] = data["stages_gradient"].rolling(5).apply(trend, raw=True)
-    data["stages_average_trend"] = data["stages_average_gradient"].rolling(5).apply(trend, raw=True)
-    data["rising_safety_trend"] = data["rising_safety_gradient"].rolling(5).apply(trend, raw=True)
-    data["fall_safety_trend"] = data["fall_safety_gradient"].rolling(5).apply(trend, raw=True)
-
-    return data
-
-def add_manda_stats(data):
-    data["pct_change"] = data["close"].pct_change()
-    data["stock_split"]             = (data["pct_change"] < -0.45) * 1
-    data["reverse_stock_split"]     = (data["pct_change"] > 2.0) * 1
-    data["manda"]                   = ((data["stock_split"] == 1) | (data["reverse_stock_split"] == 1)) * 1
-
-    return data
+def add_manda_stats(data, columns=None):
+    return apply_stats(data, manda_stats, columns)
 
 def stop_high(data):
     before = data[-2]
@@ -144,8 +188,31 @@ def stop_low(data):
     gradient = current - before
     return -limit == gradient
 
-def add_stats(data, default=0, names=[]):
+# 指定した列と前提の列 (元データの列は含まない)
+#   Noneなら全ての列
+def stats_plan(columns=None):
+    if columns is None:
+        return None
+
+    depends = {}
+    for stats in [average_stats, tec_stats, band_stats, safety_stats, stages_stats, cross_stats, trend_stats, manda_stats, cs_stats]:
+        for name, required, _ in stats:
+            depends[name] = required
+
+    plan = set()
+    targets = list(columns)
+    while len(targets) > 0:
+        name = targets.pop()
+        if name in plan or name not in depends.keys():
+            continue
+        plan.add(name)
+        targets.extend(depends[name])
+
+    return plan
+
+def add_stats(data, default=0, names=[], columns=None):
     is_t = lambda name : len(names) == 0 or name in names
+    plan = stats_plan(columns)
 
     stats = {
         "average": add_average_stats,
@@ -162,7 +229,7 @@ def add_stats(data, default=0, names=[]):
 
     for name in keys:
         try:
-            data = stats[name](data) if is_t(name) else data
+            data = stats[name](data, plan) if is_t(name) else data
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -179,84 +246,487 @@ def each(callback, data):
     return list(map(lambda x: callback(*x), data.iterrows()))
 
 # ろうそく足のパターン
-def add_cs_stats(data):
-    toint = lambda x: 1 if x else 0
-
+cs_stats = [
     # 実体
-    data["entity"] = (data["open"] - data["close"]).abs()
-    entity = numpy.array(data["entity"].values, dtype="f8")
-    entity_average = ta.SMA(entity, timeperiod=5)
-    data["entity_average"] = entity_average
+    ("entity",              ["open", "close"], lambda d: (d["open"] - d["close"]).abs()),
+    ("entity_average",      ["entity"], lambda d: ta.SMA(f8(d["entity"]), timeperiod=5)),
     # 上ヒゲ・下ヒゲ
-    data["upper_shadow"] = each(lambda i, x: x["high"] - max([x["open"], x["close"]]), data)
-    data["lower_shadow"] = each(lambda i, x: min([x["open"], x["close"]]) - x["low"], data)
+    ("upper_shadow",        ["high", "open", "close"], lambda d: d["high"] - d["close"].where(d["close"] > d["open"], d["open"])), # max([open, close])
+    ("lower_shadow",        ["low", "open", "close"], lambda d: d["close"].where(d["close"] < d["open"], d["open"]) - d["low"]), # min([open, close])
 
     ## ここから
     # 長い上ヒゲ・下ヒゲ
-    data["long_upper_shadow"] = (data["upper_shadow"] > data["entity"]) * 1
-    data["long_lower_shadow"] = (data["lower_shadow"] > data["entity"]) * 1
+    ("long_upper_shadow",   ["upper_shadow", "entity"], lambda d: (d["upper_shadow"] > d["entity"]) * 1),
+    ("long_lower_shadow",   ["lower_shadow", "entity"], lambda d: (d["lower_shadow"] > d["entity"]) * 1),
     # 陽線・陰線
-    data["yang"]   = (data["open"] < data["close"]) * 1
-    data["yin"]    = (data["open"] > data["close"]) * 1
-    data["long_yang"]  = ((data["yang"] == 1) & (data["entity"] > data["entity_average"])) * 1
-    data["long_yin"]   = ((data["yin"] == 1) & (data["entity"] > data["entity_average"])) * 1
+    ("yang",                ["open", "close"], lambda d: (d["open"] < d["close"]) * 1),
+    ("yin",                 ["open", "close"], lambda d: (d["open"] > d["close"]) * 1),
+    ("long_yang",           ["yang", "entity", "entity_average"], lambda d: ((d["yang"] == 1) & (d["entity"] > d["entity_average"])) * 1),
+    ("long_yin",            ["yin", "entity", "entity_average"], lambda d: ((d["yin"] == 1) & (d["entity"] > d["entity_average"])) * 1),
 
     # 切り上げ
-    data["low_roundup"]  = (data["low"].shift(1) < data["low"]) * 1
-    data["high_roundup"] = (data["high"].shift(1) < data["high"]) * 1
+    ("low_roundup",         ["low"], lambda d: (d["low"].shift(1) < d["low"]) * 1),
+    ("high_roundup",        ["high"], lambda d: (d["high"].shift(1) < d["high"]) * 1),
     # 切り下げ
-    data["low_rounddown"]  = (data["low"].shift(1) > data["low"]) * 1
-    data["high_rounddown"] = (data["high"].shift(1) > data["low"]) * 1
+    ("low_rounddown",       ["low"], lambda d: (d["low"].shift(1) > d["low"]) * 1),
+    ("high_rounddown",      ["high", "low"], lambda d: (d["high"].shift(1) > d["low"]) * 1),
 
     # n日以内の高値安値更新
-    data["high_update"] = (data["high"].rolling(5).max() == data["high"]) * 1
-    data["low_update"] = (data["low"].rolling(5).min() == data["low"]) * 1
+    ("high_update",         ["high"], lambda d: (d["high"].rolling(5).max() == d["high"]) * 1),
+    ("low_update",          ["low"], lambda d: (d["low"].rolling(5).min() == d["low"]) * 1),
 
     # ギャップ
-    data["yang_gap"] = (data["high"].shift(1) < data["low"]) * 1
-    data["yin_gap"]  = (data["low"].shift(1) > data["high"]) * 1
-    data["gap"]      = data["yang_gap"] + data["yin_gap"]
+    ("yang_gap",            ["high", "low"], lambda d: (d["high"].shift(1) < d["low"]) * 1),
+    ("yin_gap",             ["high", "low"], lambda d: (d["low"].shift(1) > d["high"]) * 1),
+    ("gap",                 ["yang_gap", "yin_gap"], lambda d: d["yang_gap"] + d["yin_gap"]),
     # つつみ線
-    data["tsutsumi"]      = (data["entity"].shift(1) < data["entity"]) * 1
-    data["yang_tsutsumi"] = ((data["tsutsumi"] == 1) & (data["yin"].shift(1) == 1) & (data["yang"] == 1)) * 1
-    data["yin_tsutsumi"]  = ((data["tsutsumi"] == 1) & (data["yang"].shift(1) == 1) & (data["yin"] == 1)) * 1
+    ("tsutsumi",            ["entity"], lambda d: (d["entity"].shift(1) < d["entity"]) * 1),
+    ("yang_tsutsumi",       ["tsutsumi", "yin", "yang"], lambda d: ((d["tsutsumi"] == 1) & (d["yin"].shift(1) == 1) & (d["yang"] == 1)) * 1),
+    ("yin_tsutsumi",        ["tsutsumi", "yang", "yin"], lambda d: ((d["tsutsumi"] == 1) & (d["yang"].shift(1) == 1) & (d["yin"] == 1)) * 1),
     # はらみ線
-    data["harami"]      = (data["entity"].shift(1) > data["entity"]) * 1
-    data["yang_harami"] = ((data["harami"] == 1) & (data["yin"].shift(1) == 1) & (data["yang"] == 1)) * 1
-    data["yin_harami"]  = ((data["harami"] == 1) & (data["yang"].shift(1) == 1) & (data["yin"] == 1)) * 1
+    ("harami",              ["entity"], lambda d: (d["entity"].shift(1) > d["entity"]) * 1),
+    ("yang_harami",         ["harami", "yin", "yang"], lambda d: ((d["harami"] == 1) & (d["yin"].shift(1) == 1) & (d["yang"] == 1)) * 1),
+    ("yin_harami",          ["harami", "yang", "yin"], lambda d: ((d["harami"] == 1) & (d["yang"].shift(1) == 1) & (d["yin"] == 1)) * 1),
     # 毛抜き
-    data["upper_kenuki"] = (data["upper_shadow"].shift(1) < data["upper_shadow"]) * 1
-    data["lower_kenuki"] = (data["lower_shadow"].shift(1) < data["lower_shadow"]) * 1
+    ("upper_kenuki",        ["upper_shadow"], lambda d: (d["upper_shadow"].shift(1) < d["upper_shadow"]) * 1),
+    ("lower_kenuki",        ["lower_shadow"], lambda d: (d["lower_shadow"].shift(1) < d["lower_shadow"]) * 1),
     # 宵の明星
-    data["yoi_mojo"] = ((data["yang_gap"].shift(1) == 1) & (data["yin_gap"] == 1)) * 1
+    ("yoi_mojo",            ["yang_gap", "yin_gap"], lambda d: ((d["yang_gap"].shift(1) == 1) & (d["yin_gap"] == 1)) * 1),
     # 明けの明星
-    data["ake_mojo"] = ((data["yin_gap"].shift(1) == 1) & (data["yang_gap"] == 1)) * 1
+    ("ake_mojo",            ["yin_gap", "yang_gap"], lambda d: ((d["yin_gap"].shift(1) == 1) & (d["yang_gap"] == 1)) * 1),
     # 三空
-    data["yang_sanku"] = ((data["yang_gap"].rolling(2).min() == 1) & (data["yang"].rolling(3).min() == 1)) * 1
-    data["yin_sanku"]  = ((data["yin_gap"].rolling(2).min() == 1) & (data["yin"].rolling(3).min() == 1)) * 1
+    ("yang_sanku",          ["yang_gap", "yang"], lambda d: ((d["yang_gap"].rolling(2).min() == 1) & (d["yang"].rolling(3).min() == 1)) * 1),
+    ("yin_sanku",           ["yin_gap", "yin"], lambda d: ((d["yin_gap"].rolling(2).min() == 1) & (d["yin"].rolling(3).min() == 1)) * 1),
     # 三兵
-    data["yang_sanpei"] = ((data["yang"].rolling(3).min() == 1) & (data["low_roundup"].rolling(2).min() == 1) & (data["long_upper_shadow"] == 1)) * 1
-    data["yin_sanpei"]  = ((data["yin"].rolling(3).min() == 1) & (data["high_rounddown"].rolling(2).min() == 1) & (data["long_lower_shadow"] == 1)) * 1
+    ("yang_sanpei",         ["yang", "low_roundup", "long_upper_shadow"], lambda d: ((d["yang"].rolling(3).min() == 1) & (d["low_roundup"].rolling(2).min() == 1) & (d["long_upper_shadow"] == 1)) * 1),
+    ("yin_sanpei",          ["yin", "high_rounddown", "long_lower_shadow"], lambda d: ((d["yin"].rolling(3).min() == 1) & (d["high_rounddown"].rolling(2).min() == 1) & (d["long_lower_shadow"] == 1)) * 1),
 
     # ストップ
-    data["stop_high"] = (data["close"].rolling(2).apply(stop_high, raw=True)) * 1
-    data["stop_low"] = (data["close"].rolling(2).apply(stop_low, raw=True)) * 1
+    ("stop_high",           ["close"], lambda d: (d["close"].rolling(2).apply(stop_high, raw=True)) * 1),
+    ("stop_low",            ["close"], lambda d: (d["close"].rolling(2).apply(stop_low, raw=True)) * 1),
+]
 
-    # スコア
-    data["score"] = each(lambda i, x: score(x), data)
+score_plus = ["yang_tsutsumi", "yang_harami", "lower_kenuki", "ake_mojo", "yin_sanku", "yin_sanpei"]
+score_minus = ["yin_tsutsumi", "yin_harami", "upper_kenuki", "yoi_mojo", "yang_sanku", "yang_sanpei"]
 
-    return data
+# スコア
+cs_stats.append(("score", score_plus + score_minus, lambda d: score(d)))
 
+def add_cs_stats(data, columns=None):
+    return apply_stats(data, cs_stats, stats_plan(columns))
 
-def score(data):
-    plus = ["yang_tsutsumi", "yang_harami", "lower_kenuki", "ake_mojo", "yin_sanku", "yin_sanpei"]
-    minus = ["yin_tsutsumi", "yin_harami", "upper_kenuki", "yoi_mojo", "yang_sanku", "yang_sanpei"]
 
-    plus_score = sum(list(map(lambda x: data[x], plus)))
-    minus_score = sum(list(map(lambda x: data[x], minus)))
+def score(data):
+    plus_score = sum(list(map(lambda x: data[x], score_plus)))
+    minus_score = sum(list(map(lambda x: data[x], score_minus)))
 
     return plus_score - minus_score
 
+# 1本ずつ追加して指標を更新する ======
+#   talibと同じ開始位置・初期値で計算する (talibの再帰計算とは丸め誤差程度の差が出る)
+#   先頭の欠損は読み飛ばし、途中の欠損はそのまま伝播する (talibと同じ)
+
+# 単純移動平均 (talib.SMA)
+class IncrementalSMA:
+    def __init__(self, period):
+        self.period = period
+        self.values = collections.deque()
+        self.total = 0.0
+        self.started = False
+
+    def update(self, value):
+        value = float(value)
+        if not self.started and math.isnan(value):
+            return numpy.nan
+        self.started = True
+        self.values.append(value)
+        self.total += value
+        if len(self.values) < self.period:
+            return numpy.nan
+        average = self.total / self.period
+        self.total -= self.values.popleft()
+        return average
+
+# 指数移動平均 (talib内部のINT_EMA) seedは期間分の単純平均
+class IncrementalEMA:
+    def __init__(self, period, k):
+        self.period = period
+        self.k = k
+        self.value = None
+
+    def seed(self, values):
+        total = 0.0
+        for value in values:
+            total += value
+        self.value = total / self.period
+        return self.value
+
+    def update(self, value):
+        self.value = ((value - self.value) * self.k) + self.value
+        return self.value
+
+# MACD (talib.MACD) 長期EMAの開始位置に短期EMAとシグナルを揃える
+class IncrementalMACD:
+    def __init__(self, fastperiod=12, slowperiod=26, signalperiod=9):
+        self.fast = IncrementalEMA(fastperiod, 2.0 / (fastperiod + 1))
+        self.slow = IncrementalEMA(slowperiod, 2.0 / (slowperiod + 1))
+        self.signal = IncrementalEMA(signalperiod, 2.0 / (signalperiod + 1))
+        self.values = collections.deque(maxlen=slowperiod)
+        self.macd = []
+        self.started = False
+
+    def update(self, value):
+        value = float(value)
+        if not self.started and math.isnan(value):
+            return numpy.nan, numpy.nan, numpy.nan
+
+        self.started = True
+        if self.slow.value is None:
+            self.values.append(value)
+            if len(self.values) < self.slow.period:
+                return numpy.nan, numpy.nan, numpy.nan
+            values = list(self.values)
+            macd = self.fast.seed(values[-self.fast.period:]) - self.slow.seed(values)
+        else:
+            macd = self.fast.update(value) - self.slow.update(value)
+
+        if self.signal.value is None:
+            self.macd.append(macd)
+            if len(self.macd) < self.signal.period:
+                return numpy.nan, numpy.nan, numpy.nan
+            signal = self.signal.seed(self.macd)
+            self.macd = []
+        else:
+            signal = self.signal.update(macd)
+
+        return macd, signal, macd - signal
+
+# ボリンジャーバンド (talib.BBANDS matype=0) 平均と標準偏差を返す
+class IncrementalBBANDS:
+    def __init__(self, period):
+        self.average = IncrementalSMA(period)
+        self.period = period
+        self.squares = collections.deque()
+        self.total = 0.0
+
+    def update(self, value):
+        average = self.average.update(value)
+        if not self.average.started:
+            return numpy.nan, numpy.nan
+
+        value = float(value)
+        self.squares.append(value * value)
+        self.total += value * value
+        if len(self.squares) < self.period:
+            return numpy.nan, numpy.nan
+
+        mean = self.total / self.period
+        self.total -= self.squares.popleft()
+        mean -= average * average
+        return average, math.sqrt(mean) if not mean < 0.00000001 else 0.0
+
+    @staticmethod
+    def bands(average, deviation, nbdev):
+        deviation = deviation if nbdev == 1.0 else deviation * nbdev
+        return average + deviation, average - deviation
+
+# ATR (talib.ATR) 最初は期間分のtrue rangeの単純平均
+class IncrementalATR:
+    def __init__(self, period):
+        self.period = period
+        self.valid = [False, False, False]
+        self.close = None
+        self.ranges = []
+        self.value = None
+
+    def update(self, high, low, close):
+        high, low, close = float(high), float(low), float(close)
+        if not all(self.valid):
+            self.valid = list(map(lambda x: x[0] or not math.isnan(x[1]), zip(self.valid, [high, low, close])))
+            if all(self.valid):
+                self.close = close
+            return numpy.nan
+
+        greatest = high - low
+        value = abs(self.close - high)
+        if value > greatest:
+            greatest = value
+        value = abs(self.close - low)
+        if value > greatest:
+            greatest = value
+        self.close = close
+
+        if self.value is None:
+            self.ranges.append(greatest)
+            if len(self.ranges) < self.period:
+                return numpy.nan
+            total = 0.0
+            for value in self.ranges:
+                total += value
+            self.value = total / self.period
+            return self.value
+
+        self.value = self.value + ((greatest - self.value) / self.period)
+        return self.value
+
+# 直近n本の値
+class IncrementalWindow:
+    def __init__(self, term):
+        self.values = collections.deque(maxlen=term)
+
+    def update(self, value):
+        self.values.append(value)
+        return self
+
+    # rolling(term).apply(callback, raw=True)の最後の値
+    def apply(self, callback, term=None):
+        term = self.values.maxlen if term is None else term
+        if len(self.values) < term:
+            return numpy.nan
+        windows = numpy.array([list(self.values)[-term:]], dtype="f8")
+        if numpy.isnan(windows).any():
+            return numpy.nan
+        return callback(windows)[0]
+
+    def max(self, term=None):
+        return self.apply(lambda x: x.max(axis=1), term)
+
+    def min(self, term=None):
+        return self.apply(lambda x: x.min(axis=1), term)
+
+# add_stats + add_cs_stats を1本ずつ更新する
+#   provisional=Trueで追加した足は次のupdateかrollbackで取り消される
+class IncrementalStats:
+    gradients = ["rci_long", "rci", "volume_average", "weekly_average", "daily_average", "stages_average", "stages", "fall_safety", "rising_safety", "macd", "macdhist"]
+    trends = [
+        ("daily_average_trend", "daily_gradient", 5),
+        ("weekly_average_trend", "weekly_gradient", 5),
+        ("volume_average_trend", "volume_gradient", 5),
+        ("macd_trend", "macd_gradient", 5),
+        ("macdhist_trend", "macdhist_gradient", 1),
+        ("rci_trend", "rci_gradient", 5),
+        ("rci_long_trend", "rci_long_gradient", 5),
+        ("stages_trend", "stages_gradient", 5),
+        ("stages_average_trend", "stages_average_gradient", 5),
+        ("rising_safety_trend", "rising_safety_gradient", 5),
+        ("fall_safety_trend", "fall_safety_gradient", 5),
+    ]
+    gradient_names = {"volume_average": "volume", "weekly_average": "weekly", "daily_average": "daily"}
+
+    def __init__(self, data=None, window=None):
+        self.daily_average = IncrementalSMA(5)
+        self.weekly_average = IncrementalSMA(25)
+        self.volume_average = IncrementalSMA(5)
+        self.macd = IncrementalMACD(12, 26, 9)
+        self.atr = IncrementalATR(14)
+        self.bbands = IncrementalBBANDS(25)
+        self.env_entity_average = IncrementalSMA(5)
+        self.stages_average = IncrementalSMA(10)
+        self.entity_average = IncrementalSMA(5)
+        self.close = IncrementalWindow(27)
+        self.macdhist = IncrementalWindow(100)
+        self.low = IncrementalWindow(15)
+        self.high = IncrementalWindow(15)
+        self.low_noize = IncrementalWindow(10)
+        self.high_noize = IncrementalWindow(10)
+        self.rising_safety = IncrementalWindow(3)
+        self.fall_safety = IncrementalWindow(3)
+        self.gradient = dict(map(lambda x: (x[1], IncrementalWindow(x[2])), self.trends))
+        self.cs = dict(map(lambda x: (x, IncrementalWindow(3)), ["yang", "yin", "yang_gap", "yin_gap", "low_roundup", "high_rounddown"]))
+        self.cs_high = IncrementalWindow(5)
+        self.cs_low = IncrementalWindow(5)
+        self.before = None # 前の足の一括計算前の値
+        self.before_cs = None # 前の足のローソク足の値
+        self.snapshot = None
+        self.rows = []
+        self.window = window # 保持する確定した足の数 (Noneなら全て)
+
+        if data is not None:
+            self.extend(data)
+
+    def extend(self, data):
+        for bar in data.to_dict("records"):
+            self.update(bar)
+
+    # 仮の足を追加する前の状態に戻す
+    def rollback(self):
+        if self.snapshot is not None:
+            self.__dict__.update(self.snapshot)
+            self.snapshot = None
+            self.rows.pop()
+
+    def update(self, bar, provisional=False):
+        self.rollback()
+        if provisional:
+            state = dict(filter(lambda x: x[0] not in ["rows", "snapshot"], self.__dict__.items()))
+            self.snapshot = copy.deepcopy(state)
+
+        row = self.stats(dict(bar))
+        row = self.cs_stats(row)
+        self.rows.append(row)
+        if self.window is not None and not provisional:
+            del self.rows[:-self.window]
+        return row
+
+    # 確定した最後の足の値 (仮の足は含まない)
+    def last(self, column):
+        rows = self.rows[:-1] if self.snapshot is not None else self.rows
+        return rows[-1][column] if len(rows) > 0 else None
+
+    def to_dataframe(self):
+        rows = self.rows if self.window is None else self.rows[-self.window:]
+        return pandas.DataFrame(rows)
+
+    def cross(self, row, base, target):
+        if self.before is None:
+            return 0
+        gc = (self.before[base] <= self.before[target]) and (row[base] >= row[target])
+        dc = (self.before[base] >= self.before[target]) and (row[base] <= row[target])
+        return (1 if gc else 0) + (-1 if dc else 0)
+
+    @staticmethod
+    def stages(row):
+        cross = lambda line: row["low"] < row[line] and row[line] < row["high"]
+        default = cross("daily_average")
+        p1 = row["daily_average"] < row["low"]
+        m1 = row["high"] < row["daily_average"]
+
+        stage = 1 if not default and p1 else 0
+        stage += -1 if not default and not p1 and m1 else 0
+        stage += 2 if cross("resistance") or row["resistance"] < row["high"] else 0
+        stage += -2 if cross("support") or row["low"] < row["support"] else 0
+        return stage
+
+    def stats(self, row):
+        # average
+        row["daily_average"] = self.daily_average.update(row["close"])
+        row["weekly_average"] = self.weekly_average.update(row["close"])
+        row["volume_average"] = self.volume_average.update(float(row["volume"]))
+        row["ma_divergence"] = numpy.float64(row["close"] - row["weekly_average"]) / row["weekly_average"]
+
+        # tec
+        close = self.close.update(row["close"])
+        row["rci"] = close.apply(rolling_rci, 9)
+        row["rci_long"] = close.apply(rolling_rci)
+        row["macd"], row["macdsignal"], row["macdhist"] = self.macd.update(row["close"])
+        row["macdhist_convert"] = self.macdhist.update(row["macdhist"]).apply(rolling_trend_convert)
+        row["atr"] = self.atr.update(row["high"], row["low"], row["close"])
+
+        # band
+        average, deviation = self.bbands.update(row["close"])
+        upper, lower = IncrementalBBANDS.bands(average, deviation, 1.0)
+        upper2, lower2 = IncrementalBBANDS.bands(average, deviation, 2.0)
+        row["env12"] = numpy.nan_to_num(upper2)
+        row["env11"] = numpy.nan_to_num(upper)
+        row["env09"] = numpy.nan_to_num(lower)
+        row["env08"] = numpy.nan_to_num(lower2)
+        row["env_entity"] = row["env12"] - row["env08"]
+        row["env_entity_average"] = self.env_entity_average.update(row["env_entity"])
+
+        # safety
+        low = self.low.update(row["low"])
+        high = self.high.update(row["high"])
+        row["low_noize"] = low.apply(rolling_low_noize, 2)
+        row["rising_safety"] = row["low"] + self.low_noize.update(row["low_noize"]).apply(rolling_rising_safety)
+        row["rising_safety"] = self.rising_safety.update(row["rising_safety"]).max()
+        row["high_noize"] = high.apply(rolling_high_noize, 2)
+        row["fall_safety"] = row["high"] + self.high_noize.update(row["high_noize"]).apply(rolling_fall_safety)
+        row["fall_safety"] = self.fall_safety.update(row["fall_safety"]).min()
+
+        # stages
+        row["resistance"] = high.max()
+        row["support"] = low.min()
+        row["stages"] = self.stages(row)
+        row["stages_average"] = self.stages_average.update(row["stages"])
+        row["macd_stages"] = 1 if row["macd"] > 0 else 0
+        row["macdhist_stages"] = 1 if row["macdhist"] > 0 else 0
+
+        # cross
+        row["average_cross"] = self.cross(row, "daily_average", "weekly_average")
+        row["macd_cross"] = self.cross(row, "macd", "macdsignal")
+        row["rci_cross"] = self.cross(row, "rci", "rci_long")
+        row["env12_cross"] = self.cross(row, "high", "env12")
+        row["env11_cross"] = self.cross(row, "high", "env11")
+        row["env09_cross"] = self.cross(row, "low", "env09")
+        row["env08_cross"] = self.cross(row, "low", "env08")
+        row["rising_safety_cross"] = self.cross(row, "low", "rising_safety")
+        row["fall_safety_cross"] = self.cross(row, "high", "fall_safety")
+
+        # trend
+        for column in self.gradients:
+            name = "%s_gradient" % self.gradient_names.get(column, column)
+            row[name] = 0 if self.before is None else row[column] - self.before[column]
+        for name, column, term in self.trends:
+            row[name] = self.gradient[column].update(row[column]).apply(rolling_trend)
+
+        # manda
+        row["pct_change"] = numpy.nan if self.before is None else numpy.float64(row["close"]) / self.before["close"] - 1
+        row["stock_split"] = 1 if row["pct_change"] < -0.45 else 0
+        row["reverse_stock_split"] = 1 if row["pct_change"] > 2.0 else 0
+        row["manda"] = 1 if row["stock_split"] == 1 or row["reverse_stock_split"] == 1 else 0
+
+        self.before = dict(row)
+
+        for column, value in row.items():
+            if isinstance(value, (float, numpy.floating)):
+                row[column] = numpy.nan_to_num(value)
+
+        return row
+
+    def cs_stats(self, row):
+        before = self.before_cs
+        shift = lambda column: numpy.nan if before is None else before[column]
+
+        row["entity"] = abs(row["open"] - row["close"])
+        row["entity_average"] = self.entity_average.update(row["entity"])
+        row["upper_shadow"] = row["high"] - (row["close"] if row["close"] > row["open"] else row["open"])
+        row["lower_shadow"] = (row["close"] if row["close"] < row["open"] else row["open"]) - row["low"]
+
+        row["long_upper_shadow"] = 1 if row["upper_shadow"] > row["entity"] else 0
+        row["long_lower_shadow"] = 1 if row["lower_shadow"] > row["entity"] else 0
+        row["yang"] = 1 if row["open"] < row["close"] else 0
+        row["yin"] = 1 if row["open"] > row["close"] else 0
+        row["long_yang"] = 1 if row["yang"] == 1 and row["entity"] > row["entity_average"] else 0
+        row["long_yin"] = 1 if row["yin"] == 1 and row["entity"] > row["entity_average"] else 0
+
+        row["low_roundup"] = 1 if shift("low") < row["low"] else 0
+        row["high_roundup"] = 1 if shift("high") < row["high"] else 0
+        row["low_rounddown"] = 1 if shift("low") > row["low"] else 0
+        row["high_rounddown"] = 1 if shift("high") > row["low"] else 0
+
+        row["high_update"] = 1 if self.cs_high.update(row["high"]).max() == row["high"] else 0
+        row["low_update"] = 1 if self.cs_low.update(row["low"]).min() == row["low"] else 0
+
+        row["yang_gap"] = 1 if shift("high") < row["low"] else 0
+        row["yin_gap"] = 1 if shift("low") > row["high"] else 0
+        row["gap"] = row["yang_gap"] + row["yin_gap"]
+        row["tsutsumi"] = 1 if shift("entity") < row["entity"] else 0
+        row["yang_tsutsumi"] = 1 if row["tsutsumi"] == 1 and shift("yin") == 1 and row["yang"] == 1 else 0
+        row["yin_tsutsumi"] = 1 if row["tsutsumi"] == 1 and shift("yang") == 1 and row["yin"] == 1 else 0
+        row["harami"] = 1 if shift("entity") > row["entity"] else 0
+        row["yang_harami"] = 1 if row["harami"] == 1 and shift("yin") == 1 and row["yang"] == 1 else 0
+        row["yin_harami"] = 1 if row["harami"] == 1 and shift("yang") == 1 and row["yin"] == 1 else 0
+        row["upper_kenuki"] = 1 if shift("upper_shadow") < row["upper_shadow"] else 0
+        row["lower_kenuki"] = 1 if shift("lower_shadow") < row["lower_shadow"] else 0
+        row["yoi_mojo"] = 1 if shift("yang_gap") == 1 and row["yin_gap"] == 1 else 0
+        row["ake_mojo"] = 1 if shift("yin_gap") == 1 and row["yang_gap"] == 1 else 0
+
+        for column in self.cs.keys():
+            self.cs[column].update(row[column])
+        window_min = lambda column, term: self.cs[column].min(term)
+        row["yang_sanku"] = 1 if window_min("yang_gap", 2) == 1 and window_min("yang", 3) == 1 else 0
+        row["yin_sanku"] = 1 if window_min("yin_gap", 2) == 1 and window_min("yin", 3) == 1 else 0
+        row["yang_sanpei"] = 1 if window_min("yang", 3) == 1 and window_min("low_roundup", 2) == 1 and row["long_upper_shadow"] == 1 else 0
+        row["yin_sanpei"] = 1 if window_min("yin", 3) == 1 and window_min("high_rounddown", 2) == 1 and row["long_lower_shadow"] == 1 else 0
+
+        row["stop_high"] = numpy.nan if before is None else float(stop_high([before["close"], row["close"]]))
+        row["stop_low"] = numpy.nan if before is None else float(stop_low([before["close"], row["close"]]))
+
+        row["score"] = score(row)
+
+        self.before_cs = row
+        return row
+
 def feature_columns():
     categorical_columns = [
 #        "daily_average_trend", "weekly_average_trend", "volume_average_trend", "macd_trend", "macdhist_trend",
@@ -365,6 +835,69 @@ def find(data, term, callback, tail=True):
             return abs(index)
     return None
 
+# 移動窓ごとの計算をまとめて行う (rolling(term).apply(callback, raw=True)と同じ結果)
+#   callbackは窓を並べた2次元配列を受け取る
+def rolling_apply(data, term, callback):
+    values = numpy.array(data, dtype="f8")
+    result = numpy.full(len(values), numpy.nan)
+    if len(values) < term:
+        return result
+    windows = numpy.lib.stride_tricks.sliding_window_view(values, term)
+    valid = ~numpy.isnan(windows).any(axis=1) # 欠損を含む窓はnan
+    result[term-1:][valid] = callback(windows[valid])
+    return result
+
+# 条件に合う値の平均と個数
+#   numpy.averageと同じ順序で足すように個数が同じ行ごとにまとめて計算する
+def masked_average(windows, mask):
+    counts = mask.sum(axis=1)
+    average = numpy.zeros(len(windows))
+    for count in numpy.unique(counts):
+        if count == 0:
+            continue
+        rows = counts == count
+        average[rows] = windows[rows][mask[rows]].reshape(-1, count).sum(axis=1) / count
+    return average, counts
+
+def rolling_rci(windows):
+    term = windows.shape[1]
+    index = numpy.argsort(windows[:, ::-1], axis=1)[:, ::-1]
+    d = ((numpy.arange(term) - index) ** 2).sum(axis=1)
+    return numpy.trunc((1.0 - ((6 * d) / float(term ** 3 - term))) * 100) + 0.0
+
+def rolling_trend_convert(windows):
+    last = windows[:, -1]
+    result = numpy.where(windows.max(axis=1) == last, 1, 0)
+    return numpy.where(windows.min(axis=1) == last, -1, result)
+
+def rolling_low_noize(windows):
+    d = windows[:, -2] - windows[:, -1]
+    return numpy.where(d < 0, d, 0)
+
+def rolling_high_noize(windows):
+    d = windows[:, -2] - windows[:, -1]
+    return numpy.where(d > 0, d, 0)
+
+def rolling_rising_safety(windows):
+    average, _ = masked_average(windows, windows < 0)
+    return average * 3 # 係数
+
+def rolling_fall_safety(windows):
+    average, _ = masked_average(windows, windows > 0)
+    return average * 3 # 係数
+
+def rolling_trend(windows):
+    high_average, high_count = masked_average(windows, windows > 0)
+    low_average, low_count = masked_average(windows, windows < 0)
+    high_average = numpy.abs(high_average)
+    low_average = numpy.abs(low_average)
+
+    diff = numpy.abs(low_average - high_average)
+
+    rising = (low_average < high_average) & (low_count < high_count) & (high_average / 2 < diff)
+    falling = (low_average > high_average) & (low_count > high_count) & (low_average / 2 < diff)
+    return numpy.where(rising, 1, numpy.where(falling, -1, 0))
+
 # トレンドが変わった
 def trend_convert(data):
     result = 0
@@ -659,14 +1192,141 @@ def to_datetime_by_term(date, with_time=False):
     else:
         return to_datetime(date)
 
+# 東証の営業日 (土日・祝日・年末年始(12/31~1/3)を除く)
+#   start_year ~ end_year の営業日を一度だけ計算して保存しておき、判定は配列の参照、前後の営業日は二分探索で求める
+class TradingCalendar:
+    cache_dir = os.path.expanduser("~/.cache/stocktrade")
+    version = 1 # is_business_dayを変えたら上げる
+
+    def __init__(self, start_year=2000, end_year=None):
+        end_year = datetime.now().year + 1 if end_year is None else end_year
+        self.start = numpy.datetime64("%04d-01-01" % start_year, "D")
+        path = self.path(start_year, end_year)
+        try:
+            self.flags = numpy.load(path)
+        except:
+            self.flags = self.create(start_year, end_year)
+            self.save(path, self.flags)
+        self.days = self.start + numpy.flatnonzero(self.flags)
+        self.start_ordinal = self.start.item().toordinal()
+        self.business_days = self.flags.tolist()
+
+    # jpholidayが更新されて祝日が増えたら作り直すようにバージョンを含める
+    def path(self, start_year, end_year):
+        return "%s/trading_calendar_v%s_jpholiday%s_%s_%s.npy" % (self.cache_dir, self.version, self.holiday_version(), start_year, end_year)
+
+    @staticmethod
+    def holiday_version():
+        try:
+            return importlib.metadata.version("jpholiday")
+        except:
+            return getattr(jpholiday, "__version__", "unknown")
+
+    # 一時ファイルに書いてから置き換える (他のプロセスが書きかけのファイルを読まない)
+    def save(self, path, flags):
+        temp = "%s.%s.%s.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(temp, "wb") as f:
+                numpy.save(f, flags)
+            os.replace(temp, path)
+        except:
+            pass
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def create(self, start_year, end_year):
+        days = numpy.arange(self.start, numpy.datetime64("%04d-01-01" % (end_year + 1), "D"))
+        return numpy.array(list(map(lambda x: self.is_business_day(x.item()), days)), dtype=bool)
+
+    @staticmethod
+    def is_business_day(date):
+        year_end = (date.month == 12 and date.day == 31) or (date.month == 1 and date.day <= 3)
+        return date.weekday() < 5 and not year_end and jpholiday.is_holiday_name(date) is None
+
+    def index(self, date):
+        return date.toordinal() - self.start_ordinal
+
+    def contains(self, date):
+        i = self.index(date)
+        if 0 <= i < len(self.business_days):
+            return self.business_days[i]
+        return self.is_business_day(date.date() if isinstance(date, datetime) else date)
+
+    # dateより前(inclusiveならdateを含む)のn番目の営業日 (時刻はdateのまま)
+    def previous(self, date, n=1, inclusive=False):
+        i = numpy.searchsorted(self.days, numpy.datetime64(date, "D"), side="right" if inclusive else "left") - n
+        if n < 1 or i < 0 or len(self.days) <= i or self.index(date) >= len(self.flags):
+            return self.walk(date, -1, n, inclusive)
+        return date - timedelta(days=self.index(date) - self.index(self.days[i].item()))
+
+    # dateより後(inclusiveならdateを含む)のn番目の営業日
+    def next(self, date, n=1, inclusive=False):
+        i = numpy.searchsorted(self.days, numpy.datetime64(date, "D"), side="left" if inclusive else "right") + n - 1
+        if n < 1 or i >= len(self.days) or self.index(date) < 0:
+            return self.walk(date, 1, n, inclusive)
+        return date + timedelta(days=self.index(self.days[i].item()) - self.index(date))
+
+    # n営業日後 (マイナスなら前)
+    def offset(self, date, n):
+        if n == 0:
+            return self.previous(date, 1, inclusive=True)
+        return self.next(date, n) if n > 0 else self.previous(date, -n)
+
+    # 範囲外は1日ずつ判定する
+    def walk(self, date, step, n, inclusive):
+        current = date if inclusive else date + timedelta(days=step)
+        count = 0
+        while True:
+            if self.contains(current):
+                count += 1
+                if count >= max(n, 1):
+                    return current
+            current = current + timedelta(days=step)
+
+trading_calendars = {}
+
+def trading_calendar():
+    if "default" not in trading_calendars.keys():
+        trading_calendars["default"] = TradingCalendar()
+    return trading_calendars["default"]
+
 def is_weekday(date):
-    return date.weekday() < 5 and jpholiday.is_holiday_name(date.date()) is None
+    return trading_calendar().contains(date)
 
 def select_weekday(date):
-    select = date
-    while(not is_weekday(select)):
-        select = select - relativeterm(1, with_time=True)
-    return select
+    return trading_calendar().previous(date, inclusive=True)
+
+# callback(params)を実行して (params, 結果, 秒) を返す
+def timed(callback, params):
+    start = time.time()
+    return params, callback(params), time.time() - start
+
+# callback(params)をプロセスで並列に実行し、終わった順に (params, 結果, 秒) を返す
+#   受け取っていない結果は workers * buffer 個まで (それ以上は投入を待つ)
+def parallel_imap(callback, params, workers=None, buffer=2):
+    workers = multiprocessing.cpu_count() if workers is None else workers
+
+    # プロセスの中からは並列にしない
+    if workers <= 1 or multiprocessing.current_process().daemon:
+        for p in params:
+            yield timed(callback, p)
+        return
+
+    semaphore = threading.Semaphore(workers * buffer)
+    def bounded():
+        for p in params:
+            semaphore.acquire()
+            yield (callback, p)
+
+    with multiprocessing.Pool(workers) as pool:
+        for result in pool.imap_unordered(parallel_timed, bounded()):
+            semaphore.release()
+            yield result
+
+def parallel_timed(params):
+    return timed(*params)
 
 # end_dateは含まない
 def daterange(start_date, end_date):